@@ -1,6 +1,9 @@
-import os, datetime
+import os, re, datetime, tempfile, threading, sqlite3, time, json, random, logging, smtplib
+import hashlib, uuid, mimetypes
+from urllib.parse import quote
 import os.path as op
-from flask import Flask, url_for, redirect, render_template, request, abort, session, flash
+from flask import Flask, url_for, redirect, render_template, request, abort, session, flash, g, send_file, jsonify
+from werkzeug.utils import secure_filename
 from flask_sqlalchemy import SQLAlchemy
 from flask_security import Security, SQLAlchemyUserDatastore, \
     UserMixin, RoleMixin, login_required, current_user
@@ -11,14 +14,20 @@ from flask_admin import helpers as admin_helpers
 from flask_admin import Admin, form
 from sqlalchemy.event import listens_for
 from flask_admin.form import rules
-from flask import has_app_context
+from flask_admin.actions import action
+from flask import has_app_context, has_request_context, current_app
 from flask_admin.contrib.fileadmin import FileAdmin
 from flask_admin.contrib.sqla import ModelView
 from flask_admin.form.rules import Field
 from wtforms.fields import StringField, TextAreaField
 from flask_admin.contrib.sqla.filters import BaseSQLAFilter
-from sqlalchemy.orm import deferred
+from sqlalchemy.orm import deferred, object_session, Session, selectinload, joinedload
+from sqlalchemy import and_, or_, inspect, case
+from sqlalchemy.exc import IntegrityError
+import click
 import warnings
+import weakref
+import shutil
 from wtforms import SelectField
 from wtforms.validators import Required
 from wtforms.validators import DataRequired,EqualTo,InputRequired,NumberRange
@@ -29,13 +38,165 @@ from flask_admin.model import typefmt
 from flask_admin.contrib.sqla.view import ModelView, func
 from wtforms.ext.sqlalchemy.fields import QuerySelectField
 from datetime import timedelta
+from email.mime.text import MIMEText
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager
+from xml.etree import ElementTree
+from markupsafe import Markup, escape
+import zipfile
+from collections import OrderedDict
+from operator import itemgetter
 #from flask_babelex import Babel
 
+# Optional: streaming XLSX export
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
 
-# Create Flask application
-app = Flask(__name__)
-app.config.from_pyfile('config.py')
-db = SQLAlchemy(app)
+# Optional: text of PDF documents for the File view search
+try:
+    from pdfminer.high_level import extract_text as pdf_extract_text
+except ImportError:
+    pdf_extract_text = None
+
+# Optional: thumbnails of images (Pillow) and first-page renders of PDF
+# documents (PyMuPDF) in the File view
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import fitz
+except ImportError:
+    fitz = None
+
+# Warn about the features turned off because their package is missing
+def log_missing_optional_packages(app):
+    for module, package, feature in (
+            (openpyxl, 'openpyxl', 'XLSX export of the project list'),
+            (pdf_extract_text, 'pdfminer.six', 'text search of PDF documents'),
+            (Image, 'Pillow', 'image previews in the File view'),
+            (fitz, 'PyMuPDF', 'PDF previews in the File view')):
+        if module is None:
+            app.logger.warning('%s is not installed: %s is disabled', package, feature)
+
+
+# Create the database, bound to the Flask application in create_app()
+db = SQLAlchemy()
+
+# Apply the SQLITE_PRAGMAS of the database profile to every new connection
+def install_sqlite_pragmas(app, engine):
+    pragmas = app.config.get('SQLITE_PRAGMAS', {})
+
+    @listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+# Log the queries slower than SLOW_QUERY_THRESHOLD_MS as JSON records
+slow_query_logger = logging.getLogger('rcs.slow_query')
+
+def install_slow_query_log(app, engine):
+    threshold = app.config.get('SLOW_QUERY_THRESHOLD_MS')
+    if threshold is None:
+        return
+    sample_rate = app.config.get('SLOW_QUERY_SAMPLE_RATE', 1.0)
+    if not slow_query_logger.handlers:
+        slow_query_logger.addHandler(logging.StreamHandler())
+        slow_query_logger.setLevel(logging.WARNING)
+
+    @listens_for(engine, 'before_cursor_execute')
+    def slow_query_start(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('slow_query_start', []).append(time.time())
+
+    @listens_for(engine, 'after_cursor_execute')
+    def slow_query_end(conn, cursor, statement, parameters, context, executemany):
+        elapsed_ms = (time.time() - conn.info['slow_query_start'].pop()) * 1000
+        if elapsed_ms < threshold or random.random() >= sample_rate:
+            return
+        slow_query_logger.warning(json.dumps(dict(
+            event='slow_query',
+            duration_ms=round(elapsed_ms, 2),
+            statement=statement,
+            executemany=executemany,
+            endpoint=request.endpoint if has_request_context() else None,
+        )))
+
+# SQL statements and time per request, aggregated per endpoint (for the
+# admin views that is one entry per view method, e.g. project.edit_view)
+class RequestStats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record(self, endpoint, total_ms, queries, sql_ms):
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = dict(
+                    endpoint=endpoint, requests=0, total_ms=0.0, max_ms=0.0,
+                    queries=0, max_queries=0, sql_ms=0.0)
+            stats['requests'] += 1
+            stats['total_ms'] += total_ms
+            stats['max_ms'] = max(stats['max_ms'], total_ms)
+            stats['queries'] += queries
+            stats['max_queries'] = max(stats['max_queries'], queries)
+            stats['sql_ms'] += sql_ms
+
+    def worst(self, key='avg_ms', limit=50):
+        with self._lock:
+            rows = [dict(stats) for stats in self._endpoints.values()]
+        for row in rows:
+            row['avg_ms'] = row['total_ms'] / row['requests']
+            row['avg_queries'] = float(row['queries']) / row['requests']
+            row['avg_sql_ms'] = row['sql_ms'] / row['requests']
+        rows.sort(key=lambda row: row[key], reverse=True)
+        return rows[:limit]
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+request_stats = RequestStats()
+
+def install_request_stats(app, engine):
+    if not app.config.get('REQUEST_STATS_ENABLED'):
+        return
+
+    @listens_for(engine, 'before_cursor_execute')
+    def request_stats_start(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('request_stats_start', []).append(time.time())
+
+    @listens_for(engine, 'after_cursor_execute')
+    def request_stats_end(conn, cursor, statement, parameters, context, executemany):
+        elapsed_ms = (time.time() - conn.info['request_stats_start'].pop()) * 1000
+        if has_request_context():
+            stats = getattr(g, 'request_stats', None)
+            if stats is not None:
+                stats['queries'] += 1
+                stats['sql_ms'] += elapsed_ms
+
+    @app.before_request
+    def request_stats_begin():
+        g.request_stats = dict(start=time.time(), queries=0, sql_ms=0.0)
+
+    @app.after_request
+    def request_stats_finish(response):
+        stats = getattr(g, 'request_stats', None)
+        if stats is None:
+            return response
+        total_ms = (time.time() - stats['start']) * 1000
+        request_stats.record(request.endpoint or request.path, total_ms,
+                             stats['queries'], stats['sql_ms'])
+        response.headers['Server-Timing'] = 'sql;desc="%d queries";dur=%.2f, total;dur=%.2f' % (
+            stats['queries'], stats['sql_ms'], total_ms)
+        return response
 
 '''
 # Initialize babel
@@ -51,13 +212,9 @@ def get_locale():
     return session.get('lang', 'en')
 '''
 
-# Create directory for file fields to use
+# Directory for file fields to use, created in create_app()
 file_path = op.join(op.dirname(__file__), 'static')
 #file_path = "C:\\Users\\user\\Desktop"
-try:
-    os.mkdir(file_path)
-except OSError:
-    pass
 
 # Define models
 roles_users = db.Table(
@@ -105,8 +262,6 @@ class Role(db.Model, RoleMixin):
     def __str__(self):
         return self.name
 
-role = Role.query.get(4)
-
 class Team(db.Model, RoleMixin):
     id = db.Column(db.Integer(), primary_key=True)
     name = db.Column(db.String(80), unique=True)
@@ -123,13 +278,14 @@ class User(db.Model, UserMixin):
     password = db.Column(db.String(255))
     active = db.Column(db.Boolean())
     confirmed_at = db.Column(db.DateTime())
-    roles = db.relationship('Role', secondary=roles_users,
+    roles = db.relationship('Role', secondary=roles_users, lazy='joined',
                             backref=db.backref('users', lazy='dynamic'))
     teams = db.relationship('Team', secondary=teams_users,uselist=False,
                             backref=db.backref('users', lazy='dynamic'))
     
     #reviewer_1 = db.relationship('Project', backref='reviewer_1')
-    reviewer_2 = db.relationship('Project', backref='reviewer_2')
+    reviewer_2 = db.relationship('Project', backref='reviewer_2',
+                                 foreign_keys='Project.reviewer1_id')
 
 
     def __str__(self):
@@ -149,8 +305,8 @@ class Project(db.Model):
     updated_on = db.Column(db.DateTime, onupdate=datetime.datetime.now)
     notes = db.Column(db.Text, nullable=False)
     reviewer1 = db.Column(db.Unicode(128)) 
-    reviewer1_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    #reviewer2_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    reviewer1_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    reviewer2_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     review1 = db.Column(db.Boolean())
     comment1 = db.Column(db.UnicodeText)
     reviewer2 = db.Column(db.Unicode(128))  
@@ -165,12 +321,168 @@ class Project(db.Model):
     teams = db.Column(db.Unicode(128))
     #teams = db.relationship('Team', secondary=project_teams,uselist=False,
                             #backref=db.backref('projectss', lazy='dynamic'))  
+
+    # The developer and team by id; name and teams keep the display text
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    team_id = db.Column(db.Integer, db.ForeignKey('team.id'))
+
+    # Where the project is in the review order, see review_stage_of()
+    review_stage = db.Column(db.Unicode(16), default=u'pending_r1', nullable=False)
+
+    # Indexes for the keyset pagination (submitted_at, id) and for the
+    # list filters, so a filtered page is also served in submitted_at order
+    __table_args__ = (
+        db.Index('ix_project_submitted_at_id', 'submitted_at', 'id'),
+        db.Index('ix_project_teams_submitted_at', 'teams', 'submitted_at'),
+        db.Index('ix_project_name_submitted_at', 'name', 'submitted_at'),
+        db.Index('ix_project_project_name_submitted_at', 'project_name', 'submitted_at'),
+        db.Index('ix_project_approve_submitted_at', 'approve', 'submitted_at'),
+        db.Index('ix_project_owner_id_submitted_at', 'owner_id', 'submitted_at'),
+        db.Index('ix_project_team_id_submitted_at', 'team_id', 'submitted_at'),
+        # Review queues: partial indexes hold only the projects still waiting
+        db.Index('ix_project_pending_r1', 'reviewer1_id', 'submitted_at', 'id',
+                 sqlite_where=review_stage == u'pending_r1',
+                 postgresql_where=review_stage == u'pending_r1'),
+        db.Index('ix_project_pending_r2', 'reviewer2_id', 'submitted_at', 'id',
+                 sqlite_where=review_stage == u'pending_r2',
+                 postgresql_where=review_stage == u'pending_r2'),
+        db.Index('ix_project_pending_final', 'submitted_at', 'id',
+                 sqlite_where=review_stage == u'pending_final',
+                 postgresql_where=review_stage == u'pending_final'),
+    )
  
     def __unicode__(self):
         return self.name
     #def __init__(self, updated_on=None):
       #self.updated_on = datetime.utcnow()
 
+# Outbox of the reviewer notifications. Rows are written in the transaction
+# that changes the project and sent later by the NotificationWorker.
+class Notification(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'))
+    recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    status = db.Column(db.String(16), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.now)
+    claimed_at = db.Column(db.DateTime)
+    # A failed notification is retried from then on, with exponential backoff
+    next_attempt_at = db.Column(db.DateTime)
+    sent_at = db.Column(db.DateTime)
+    last_error = db.Column(db.UnicodeText)
+    project = db.relationship('Project')
+
+    __table_args__ = (
+        db.Index('ix_notification_status_id', 'status', 'id'),
+    )
+
+# SHA-256 of the File view artifacts by path, see ArtifactHashIndex
+class ArtifactHash(db.Model):
+    path = db.Column(db.Unicode(512), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    mtime = db.Column(db.Float, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=False)
+
+# Files of a project: the files uploaded into the "<project id>" folder of the
+# File view, so listing a project's artifacts is one indexed query instead
+# of a walk of the folder
+class ProjectArtifact(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id', ondelete='CASCADE'), nullable=False)
+    # Relative to the File view base path, with / separators
+    path = db.Column(db.Unicode(512), nullable=False, unique=True)
+    size = db.Column(db.BigInteger)
+    sha256 = db.Column(db.String(64))
+    uploader_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    uploaded_at = db.Column(db.DateTime, default=datetime.datetime.now)
+    project = db.relationship('Project')
+    uploader = db.relationship('User')
+
+    __table_args__ = (
+        db.Index('ix_project_artifact_project_id_uploaded_at', 'project_id', 'uploaded_at'),
+    )
+
+    @property
+    def name(self):
+        return self.path.rsplit('/', 1)[-1]
+
+# Review stages, in the review order
+REVIEW_STAGES = ('pending_r1', 'pending_r2', 'pending_final', 'approved')
+
+def review_stage_of(project):
+    if project.approve:
+        return u'approved'
+    if project.review2:
+        return u'pending_final'
+    if project.review1:
+        return u'pending_r2'
+    return u'pending_r1'
+
+# Add and backfill Project.review_stage on a database created before it
+def add_review_stage_column():
+    columns = [c['name'] for c in inspect(db.engine).get_columns('project')]
+    if 'review_stage' in columns:
+        return
+    db.engine.execute(db.text(
+        "ALTER TABLE project ADD COLUMN review_stage VARCHAR(16) NOT NULL DEFAULT 'pending_r1'"))
+    db.engine.execute(db.text(
+        "UPDATE project SET review_stage = CASE "
+        "WHEN approve THEN 'approved' "
+        "WHEN review2 THEN 'pending_final' "
+        "WHEN review1 THEN 'pending_r2' "
+        "ELSE 'pending_r1' END"))
+
+# Move the developer, team and reviewers of existing projects from the name
+# strings to the id columns. Runs in small batches, each in its own
+# transaction, so it can run while the application is serving. A first name
+# shared by several users can't be resolved; those rows keep a NULL id and
+# are counted in the result for a manual fix.
+REFERENCE_COLUMNS = (
+    ('owner_id', 'INTEGER REFERENCES "user" (id)'),
+    ('reviewer2_id', 'INTEGER REFERENCES "user" (id)'),
+    ('team_id', "INTEGER REFERENCES team (id)"),
+)
+
+def migrate_reference_columns(batch_size=1000):
+    columns = [c['name'] for c in inspect(db.engine).get_columns('project')]
+    for name, ddl in REFERENCE_COLUMNS:
+        if name not in columns:
+            db.engine.execute(db.text("ALTER TABLE project ADD COLUMN %s %s" % (name, ddl)))
+
+    users = {}
+    for pk, first_name in db.engine.execute(db.select([User.id, User.first_name])):
+        users.setdefault(first_name, []).append(pk)
+    user_ids = dict((name, ids[0]) for name, ids in users.items() if len(ids) == 1)
+    team_ids = dict((name, pk) for pk, name in db.engine.execute(db.select([Team.id, Team.name])))
+
+    unresolved = 0
+    last_id = 0
+    while True:
+        rows = db.engine.execute(db.text(
+            "SELECT id, name, teams, reviewer1, reviewer2 FROM project "
+            "WHERE id > :last_id AND (owner_id IS NULL OR team_id IS NULL "
+            "OR reviewer1_id IS NULL OR reviewer2_id IS NULL) "
+            "ORDER BY id LIMIT :limit"), last_id=last_id, limit=batch_size).fetchall()
+        if not rows:
+            break
+        updates = []
+        for row in rows:
+            update = dict(id=row.id, owner_id=user_ids.get(row.name), team_id=team_ids.get(row.teams),
+                          reviewer1_id=user_ids.get(row.reviewer1),
+                          reviewer2_id=user_ids.get(row.reviewer2))
+            if None in update.values():
+                unresolved += 1
+            updates.append(update)
+        with db.engine.begin() as connection:
+            connection.execute(db.text(
+                "UPDATE project SET owner_id = COALESCE(owner_id, :owner_id), "
+                "team_id = COALESCE(team_id, :team_id), "
+                "reviewer1_id = COALESCE(reviewer1_id, :reviewer1_id), "
+                "reviewer2_id = COALESCE(reviewer2_id, :reviewer2_id) WHERE id = :id"), updates)
+        last_id = rows[-1].id
+    return unresolved
+
 # Customized the filter interface
 class CustomView(ModelView):
     list_template = 'list.html'
@@ -184,7 +496,8 @@ class CustomizableField(Field):
         self.extra_field_args = field_args
 
     def __call__(self, form, form_opts=None, field_args={}):
-        field_args.update(self.extra_field_args)
+        # Merge into a copy: the rule sets are shared between requests
+        field_args = dict(field_args, **self.extra_field_args)
         return super(CustomizableField, self).__call__(form, form_opts, field_args)
 
 # Dynamically make "readonly" field afer approval: for one liner string field
@@ -225,6 +538,48 @@ class ReadOnlyTextAreaField(TextAreaField):
         if not self.readonly_condition():
             super(ReadOnlyTextAreaField, self).populate_obj(obj, name)
 
+# Reviewer dropdown: the options are labelled with the full name and email,
+# as first names aren't unique; the id goes to <name>_id and the first name
+# to <name> for display
+class ReviewerSelectField(SelectField):
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('coerce', int)
+        super(ReviewerSelectField, self).__init__(*args, **kwargs)
+        self.first_names = {}
+
+    def set_users(self, users):
+        self.choices = [(pk, label) for pk, first_name, label in users]
+        self.first_names = dict((pk, first_name) for pk, first_name, label in users)
+
+    def populate_obj(self, obj, name):
+        setattr(obj, name + '_id', self.data)
+        setattr(obj, name, self.first_names.get(self.data))
+
+# Filter on a foreign key column. Its options come from the database, so
+# they aren't loaded when the view is built (there's no app context, nor
+# maybe tables, yet) but on every request, by the view's _get_filter_groups()
+class FilterReference(BaseSQLAFilter):
+    def get_options(self, view):
+        return None
+
+    def get_request_options(self):
+        return [(key, u'%s' % label) for key, label in self.options()]
+
+    def apply(self, query, value, alias=None):
+        try:
+            return query.filter(self.column == int(value))
+        except ValueError:
+            return query
+
+    def operation(self):
+        return 'EqualTo'
+
+def team_options():
+    return [(str(pk), name) for pk, name in db.session.query(Team.id, Team.name).order_by(Team.name)]
+
+def developer_options():
+    return [(str(pk), label) for pk, first_name, label in reviewer_directory.users('developer')]
+
 # Approve custom filter class
 class FilterApprove(BaseSQLAFilter):
     def apply(self, query, value, alias=None):
@@ -239,7 +594,62 @@ class FilterApprove(BaseSQLAFilter):
 
 # Setup Flask-Security
 user_datastore = SQLAlchemyUserDatastore(db, User, Role)
-security = Security(app, user_datastore)
+security = Security()
+
+
+# Role names of the current user, resolved once per request and kept on `g`.
+# User.roles is joined-loaded with the user, so this costs no extra SQL.
+def current_roles():
+    roles = getattr(g, 'user_roles', None)
+    if roles is None:
+        if current_user.is_authenticated:
+            roles = frozenset(role.name for role in current_user.roles)
+        else:
+            roles = frozenset()
+        g.user_roles = roles
+    return roles
+
+def user_has_role(*names):
+    return not current_roles().isdisjoint(names)
+
+
+# View flag (can_edit, can_upload, ...) read from the permissions of the
+# current request, so a view instance shared between threads is never mutated
+class RequestPermission(object):
+    def __init__(self, name, default=False):
+        self.name = name
+        self.default = default
+
+    def __get__(self, view, owner):
+        if view is None:
+            return self
+        permissions = view.get_permissions() if has_request_context() else None
+        if permissions is None:
+            return self.default
+        return permissions.get(self.name, self.default)
+
+# Resolve a view's permissions from the user's roles once per request
+class RolePermissionMixin(object):
+    role_permissions = ()
+
+    def get_permissions(self):
+        cache = getattr(g, 'view_permissions', None)
+        if cache is None:
+            cache = g.view_permissions = {}
+        if self.endpoint not in cache:
+            cache[self.endpoint] = self._resolve_permissions()
+        return cache[self.endpoint]
+
+    def _resolve_permissions(self):
+        if not current_user.is_active or not current_user.is_authenticated:
+            return None
+        for role, permissions in self.role_permissions:
+            if user_has_role(role):
+                return permissions
+        return None
+
+    def is_accessible(self):
+        return self.get_permissions() is not None
 
 
 # Create customized model view class for all users to edit their own profiles
@@ -248,7 +658,7 @@ class MyModelView(ModelView):
         if not current_user.is_active or not current_user.is_authenticated:
             return False
 
-        #if current_user.has_role('administrator'):
+        #if user_has_role('administrator'):
             #return True
         return True
 
@@ -272,7 +682,7 @@ class AdminModelView(ModelView):
         if not current_user.is_active or not current_user.is_authenticated:
             return False
 
-        if current_user.has_role('administrator'):
+        if user_has_role('administrator'):
             return True
 
         return False
@@ -302,12 +712,32 @@ class AdminModelView(ModelView):
     create_template = 'rule_create.html'
     edit_template = 'rule_edit.html'
     
-class UserView(MyModelView):
+# Eager load the relationship columns of a list view, so a page of rows
+# costs a constant number of queries.
+# column_eager_load maps a relationship to 'selectin' or 'joined'.
+class EagerLoadMixin(object):
+    column_eager_load = {}
+
+    eager_strategies = {
+        'selectin': selectinload,
+        'joined': joinedload,
+    }
+
+    def apply_eager_load(self, query):
+        options = [self.eager_strategies[strategy](getattr(self.model, name))
+                   for name, strategy in self.column_eager_load.items()]
+        return query.options(*options) if options else query
+
+    def get_query(self):
+        return self.apply_eager_load(super(EagerLoadMixin, self).get_query())
+
+class UserView(EagerLoadMixin, MyModelView):
     # Restrict only the current user can see his own profile
     can_delete = False
     can_create = False
+    column_eager_load = dict(roles='selectin', teams='joined')
     def get_query(self):
-      return self.session.query(self.model).filter(self.model.id==current_user.id)
+      return self.apply_eager_load(self.session.query(self.model).filter(self.model.id==current_user.id))
 
     def get_count_query(self):
       return self.session.query(func.count('*')).filter(self.model.id==current_user.id)
@@ -338,8 +768,9 @@ class UserView(MyModelView):
     edit_template = 'rule_edit.html'
 
 # This class is for admin to manage all users
-class UserListView(AdminModelView):
+class UserListView(EagerLoadMixin, AdminModelView):
     can_delete = True
+    column_eager_load = dict(roles='selectin', teams='joined')
     form_args = dict(
         teams=dict(validators=[DataRequired()]),
         first_name=dict(validators=[DataRequired()]),
@@ -378,12 +809,204 @@ class TeamView(AdminModelView):
     create_template = 'rule_create.html'
     edit_template = 'rule_edit.html'
 
+# Create the Project indexes on an existing database (create_all skips them
+# when the table is already there)
+def create_project_indexes():
+    existing = set(index['name'] for index in inspect(db.engine).get_indexes('project'))
+    for index in Project.__table__.indexes:
+        if index.name not in existing:
+            index.create(db.engine)
+
+# Bring an existing database up to the current schema: the factory never
+# touches the database, so this runs from the upgrade-db command (and from the
+# development server below). Returns the number of projects whose references
+# couldn't be resolved.
+def upgrade_database():
+    db.create_all()
+    add_review_stage_column()
+    unresolved = migrate_reference_columns()
+    create_project_indexes()
+    create_search_index()
+    return unresolved
+
+# Full-text search index over the Project text columns (SQLite FTS5).
+# The index keeps its own copy of the text, keyed by rowid == project.id,
+# and is kept in sync by the mapper events below. It is created and dropped
+# together with the project table, or built for an existing table by the
+# upgrade-db command; the mapper events do nothing on a database that has no
+# index (yet).
+PROJECT_FTS_COLUMNS = ('teams', 'name', 'project_name', 'notes', 'SVN',
+                       'comment1', 'comment2', 'comment3')
+
+# Whether project_fts exists, per engine
+_search_index_exists = weakref.WeakKeyDictionary()
+
+def search_index_enabled(bind):
+    if bind.dialect.name != 'sqlite':
+        return False
+    exists = _search_index_exists.get(bind.engine)
+    if exists is None:
+        exists = _search_index_exists[bind.engine] = bool(bind.execute(db.text(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='project_fts'")).scalar())
+    return exists
+
+def create_search_index(rebuild=False, bind=None):
+    bind = bind or db.engine
+    if bind.dialect.name != 'sqlite':
+        return
+    if rebuild:
+        drop_search_index(bind)
+    if search_index_enabled(bind) or not bind.dialect.has_table(bind, 'project'):
+        return
+    columns = ', '.join(PROJECT_FTS_COLUMNS)
+    bind.execute(db.text(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS project_fts USING fts5(%s, tokenize='unicode61')" % columns))
+    bind.execute(db.text(
+        "INSERT INTO project_fts(rowid, %s) SELECT id, %s FROM project" % (columns, columns)))
+    _search_index_exists[bind.engine] = True
+
+def drop_search_index(bind):
+    if bind.dialect.name == 'sqlite':
+        bind.execute(db.text("DROP TABLE IF EXISTS project_fts"))
+        _search_index_exists[bind.engine] = False
+
+@listens_for(Project.__table__, 'after_create')
+def project_table_created(target, connection, **kw):
+    create_search_index(rebuild=True, bind=connection)
+
+@listens_for(Project.__table__, 'after_drop')
+def project_table_dropped(target, connection, **kw):
+    drop_search_index(connection)
+
+def _index_project(connection, target):
+    columns = ', '.join(PROJECT_FTS_COLUMNS)
+    params = ', '.join(':' + c for c in PROJECT_FTS_COLUMNS)
+    values = dict((c, getattr(target, c)) for c in PROJECT_FTS_COLUMNS)
+    values['id'] = target.id
+    connection.execute(db.text("DELETE FROM project_fts WHERE rowid = :id"), id=target.id)
+    connection.execute(db.text(
+        "INSERT INTO project_fts(rowid, %s) VALUES (:id, %s)" % (columns, params)), **values)
+
+@listens_for(Project, 'after_insert')
+def project_after_insert(mapper, connection, target):
+    if search_index_enabled(connection):
+        _index_project(connection, target)
+
+@listens_for(Project, 'after_update')
+def project_after_update(mapper, connection, target):
+    if search_index_enabled(connection):
+        _index_project(connection, target)
+
+@listens_for(Project, 'after_delete')
+def project_after_delete(mapper, connection, target):
+    if search_index_enabled(connection):
+        connection.execute(db.text("DELETE FROM project_fts WHERE rowid = :id"), id=target.id)
+
+# Turn the search box text into an FTS5 query: every word is a quoted
+# prefix term, so user input can't inject FTS operators
+def fts_query(search):
+    terms = [t.replace('"', '""') for t in search.split()]
+    return ' '.join('"%s"*' % t for t in terms if t)
+
+# Version stamps of the caches kept by every worker process. A write that
+# makes a cache stale bumps its stamp in the same transaction; a process
+# seeing a stamp other than the one its copy was loaded at reloads it.
+class CacheVersion(db.Model):
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+CACHE_VERSION_NAMES = ('reviewers',)
+
+@listens_for(CacheVersion.__table__, 'after_create')
+def cache_version_created(target, connection, **kw):
+    connection.execute(target.insert(), [dict(name=name, version=0) for name in CACHE_VERSION_NAMES])
+
+def read_cache_version(name):
+    return db.session.query(CacheVersion.version).filter(CacheVersion.name == name).scalar() or 0
+
+def bump_cache_version(connection, name):
+    table = CacheVersion.__table__
+    connection.execute(table.update().where(table.c.name == name)
+                       .values(version=table.c.version + 1))
+
+# "First Last <email>", to tell apart the users sharing a first name
+def user_label(user):
+    name = u' '.join(part for part in (user.first_name, user.last_name) if part)
+    return u'%s <%s>' % (name, user.email)
+
+# Reviewers per role name, cached between requests. The cache is cleared
+# whenever a User or Role is written (role membership lives in roles_users,
+# which is flushed together with its User/Role), and once more after the
+# commit so a reload racing the flush can't keep stale data. The write also
+# bumps the "reviewers" cache version, which the other processes check once
+# per request.
+class ReviewerDirectory(object):
+    version_name = 'reviewers'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._version = None
+        self._generation = 0
+
+    def current_version(self):
+        if not has_request_context():
+            return read_cache_version(self.version_name)
+        version = getattr(g, 'reviewers_version', None)
+        if version is None:
+            version = g.reviewers_version = read_cache_version(self.version_name)
+        return version
+
+    def users(self, role_name):
+        version = self.current_version()
+        with self._lock:
+            if version != self._version:
+                self._cache.clear()
+                self._version = version
+                self._generation += 1
+            cached = self._cache.get(role_name)
+            generation = self._generation
+        if cached is not None:
+            return cached
+
+        rows = db.session.query(User.id, User.first_name, User.last_name, User.email) \
+            .join(User.roles).filter(Role.name == role_name) \
+            .order_by(User.first_name, User.last_name, User.id).all()
+        cached = tuple((row.id, row.first_name, user_label(row)) for row in rows)
+        with self._lock:
+            if generation == self._generation:
+                self._cache[role_name] = cached
+        return cached
+
+    def invalidate(self):
+        with self._lock:
+            self._cache.clear()
+            self._generation += 1
+
+reviewer_directory = ReviewerDirectory()
+
+def _reviewers_changed(mapper, connection, target):
+    reviewer_directory.invalidate()
+    bump_cache_version(connection, reviewer_directory.version_name)
+    session = object_session(target)
+    if session is not None:
+        session.info['reviewers_changed'] = True
+
+for _model in (User, Role):
+    for _event in ('after_insert', 'after_update', 'after_delete'):
+        listens_for(_model, _event)(_reviewers_changed)
+
+@listens_for(Session, 'after_commit')
+def reviewers_after_commit(session):
+    if session.info.pop('reviewers_changed', False):
+        reviewer_directory.invalidate()
+
 def reviewer1_choices():
-    return User.query.join(User.roles).filter(Role.id == 4)
+    return [(pk, label) for pk, first_name, label in reviewer_directory.users('reviewer1')]
 def reviewer2_choices():
-    return User.query.join(User.roles).filter(Role.id == 5)
+    return [(pk, label) for pk, first_name, label in reviewer_directory.users('reviewer2')]
 
-class SWProjectView(sqla.ModelView):
+class SWProjectView(RolePermissionMixin, sqla.ModelView):
     # The developer can only see her/his project
     #def get_query(self):
       #return self.session.query(self.model).filter(self.model.teams==current_user.teams.name)
@@ -406,9 +1029,6 @@ class SWProjectView(sqla.ModelView):
                      'reviewer2': [ ('Steve','Steve')]
                    }
     '''
-    reviewer1 = QuerySelectField(query_factory = reviewer1_choices)
-    reviewer2 = QuerySelectField(query_factory = reviewer2_choices)
-    
 
     # Date formatter
     column_type_formatters = MY_DEFAULT_FORMATTERS
@@ -437,8 +1057,22 @@ class SWProjectView(sqla.ModelView):
         'notes': ReadOnlyTextAreaField,
         'comment1': ReadOnlyTextAreaField,  
         'comment2': ReadOnlyTextAreaField,
+        'reviewer1': ReviewerSelectField,
+        'reviewer2': ReviewerSelectField,
     }
 
+    # The dropdown choices come from the cached reviewer directory
+    def _set_reviewer_choices(self, form):
+        if hasattr(form, 'reviewer1'):
+            form.reviewer1.set_users(reviewer_directory.users('reviewer1'))
+        if hasattr(form, 'reviewer2'):
+            form.reviewer2.set_users(reviewer_directory.users('reviewer2'))
+        return form
+
+    def create_form(self, obj=None):
+        form = super(SWProjectView, self).create_form(obj)
+        return self._set_reviewer_choices(form)
+
     def edit_form(self, obj=None):
         def readonly_condition():
             if obj is None:
@@ -454,102 +1088,368 @@ class SWProjectView(sqla.ModelView):
         form.comment1.readonly_condition = readonly_condition
         form.comment2.readonly_condition = readonly_condition
 
-        return form
+        return self._set_reviewer_choices(form)
     
+    # Keyset pagination on (submitted_at, id): the default list order is
+    # served by an index range scan and no count(*) is issued, so page N
+    # costs the same as page 1. Sorting by another column falls back to
+    # the OFFSET pagination of flask-admin. Projects without a submitted_at
+    # (older rows) come last, by id, read by a query of their own so that
+    # both parts stay on the index; their cursor has an empty date.
+    keyset_pagination = True
+    simple_list_pager = True
+    column_default_sort = ('submitted_at', True)
+    keyset_format = '%Y-%m-%d %H:%M:%S.%f'
+
+    def _encode_keyset(self, model):
+        if model.submitted_at is None:
+            return '|%d' % model.id
+        return '%s|%d' % (model.submitted_at.strftime(self.keyset_format), model.id)
+
+    def _decode_keyset(self, value):
+        try:
+            submitted_at, pk = value.rsplit('|', 1)
+            if not submitted_at:
+                return None, int(pk)
+            return datetime.datetime.strptime(submitted_at, self.keyset_format), int(pk)
+        except (AttributeError, ValueError):
+            return None
+
+    def get_list(self, page, sort_column, sort_desc, search, filters,
+                 execute=True, page_size=None):
+        if not self.keyset_pagination or sort_column is not None or search:
+            return super(SWProjectView, self).get_list(page, sort_column, sort_desc, search,
+                                                       filters, execute, page_size)
+
+        after = before = None
+        if page:
+            after = self._decode_keyset(request.args.get('after'))
+            before = self._decode_keyset(request.args.get('before'))
+        if page and after is None and before is None:
+            # No cursor (e.g. a hand typed page number): use OFFSET
+            return super(SWProjectView, self).get_list(page, sort_column, sort_desc, search,
+                                                       filters, execute, page_size)
+
+        # Let flask-admin apply search and filters, then page on the index
+        count, query = super(SWProjectView, self).get_list(None, None, False, search, filters,
+                                                           execute=False, page_size=0)
+        if page_size is None:
+            page_size = self.page_size
+
+        submitted_at, pk = Project.submitted_at, Project.id
+        query = query.order_by(None)
+        if not execute:
+            # A single query for the export (page 0, no cursor)
+            query = query.order_by(submitted_at == None, submitted_at.desc(), pk.desc())
+            if page_size:
+                query = query.limit(page_size)
+            return count, query
+
+        dated = query.filter(submitted_at != None)
+        undated = query.filter(submitted_at == None)
+        if before is not None:
+            # Walk back from the cursor, in ascending order
+            if before[0] is None:
+                parts = [undated.filter(pk > before[1]).order_by(pk.asc()),
+                         dated.order_by(submitted_at.asc(), pk.asc())]
+            else:
+                parts = [dated.filter(or_(submitted_at > before[0],
+                                          and_(submitted_at == before[0], pk > before[1])))
+                         .order_by(submitted_at.asc(), pk.asc())]
+        elif after is not None and after[0] is None:
+            parts = [undated.filter(pk < after[1]).order_by(pk.desc())]
+        else:
+            if after is not None:
+                dated = dated.filter(or_(submitted_at < after[0],
+                                         and_(submitted_at == after[0], pk < after[1])))
+            parts = [dated.order_by(submitted_at.desc(), pk.desc()),
+                     undated.order_by(pk.desc())]
+
+        data = []
+        for part in parts:
+            if page_size:
+                if len(data) >= page_size:
+                    break
+                part = part.limit(page_size - len(data))
+            data.extend(part.all())
+        if before is not None:
+            data.reverse()
+
+        # Remember the cursors of this page for the pager links
+        g.project_keyset = dict(
+            page=page or 0,
+            first=self._encode_keyset(data[0]) if data else None,
+            last=self._encode_keyset(data[-1]) if data else None,
+        )
+        return count, data
+
+    def _get_list_url(self, view_args):
+        extra_args = dict((k, v) for k, v in view_args.extra_args.items()
+                          if k not in ('after', 'before'))
+        state = getattr(g, 'project_keyset', None)
+        if state is not None and view_args.sort is None and view_args.page:
+            if view_args.page == state['page'] + 1 and state['last']:
+                extra_args['after'] = state['last']
+            elif view_args.page == state['page'] - 1 and state['first']:
+                extra_args['before'] = state['first']
+        return super(SWProjectView, self)._get_list_url(view_args.clone(extra_args=extra_args))
+
     # The filters and export
     can_export = True
+    export_types = ['csv', 'xlsx'] if openpyxl is not None else ['csv']
+    export_batch_size = 1000
+
+    # flask-admin's check from its _export_data(): a macro formatter (named
+    # 'inner') can't be rendered outside a template
+    def _check_export_formatters(self):
+        exported = [col for col, _ in self._export_columns]
+        for col, func in self.column_formatters_export.items():
+            if col in exported and func.__name__ == 'inner':
+                raise NotImplementedError(
+                    'Macros are not implemented in export. Exclude column in'
+                    ' column_formatters_export, column_export_list, or '
+                    ' column_export_exclude_list. Column: %s' % (col,)
+                )
+
+    # Hand the export a streaming query instead of a list: rows are fetched
+    # from a server-side cursor in batches while the CSV response is written
+    def _export_data(self):
+        self._check_export_formatters()
+        view_args = self._get_list_extra_args()
+
+        sort_column = self._get_column_by_idx(view_args.sort)
+        if sort_column is not None:
+            sort_column = sort_column[0]
+
+        count, query = self.get_list(0, sort_column, view_args.sort_desc,
+                                     view_args.search, view_args.filters,
+                                     execute=False, page_size=self.export_max_rows)
+        query = query.execution_options(stream_results=True).yield_per(self.export_batch_size)
+        return count, query
+
+    # XLSX through a write-only workbook, spooled to a temporary file so the
+    # worker memory stays flat however many rows are exported
+    def _export_tablib(self, export_type, return_url):
+        if export_type != 'xlsx' or openpyxl is None:
+            return super(SWProjectView, self)._export_tablib(export_type, return_url)
+
+        count, data = self._export_data()
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append([c[1] for c in self._export_columns])
+        for row in data:
+            sheet.append([self.get_export_value(row, c[0]) for c in self._export_columns])
+
+        output = tempfile.TemporaryFile()
+        workbook.save(output)
+        output.seek(0)
+        filename = secure_filename(self.get_export_name(export_type='xlsx'))
+        return send_file(output, as_attachment=True, attachment_filename=filename,
+                         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
     column_searchable_list = ('teams','name', 'project_name',) 
+
+    # The search box queries the FTS5 index (which also covers notes, SVN and
+    # the review comments). The hits are ordered by rank unless a sort column
+    # is selected, see _apply_sorting()
+    def _apply_search(self, query, count_query, joins, count_joins, search):
+        if not search_index_enabled(self.session.get_bind()):
+            return super(SWProjectView, self)._apply_search(query, count_query, joins,
+                                                            count_joins, search)
+        terms = fts_query(search)
+        if not terms:
+            return query, count_query, joins, count_joins
+
+        hits = db.text("SELECT rowid AS id, rank AS rank FROM project_fts "
+                       "WHERE project_fts MATCH :terms").bindparams(terms=terms)
+        hits = hits.columns(id=db.Integer, rank=db.Float).alias('project_fts_hits')
+        query = query.join(hits, hits.c.id == Project.id)
+        if count_query is not None:
+            count_query = count_query.join(hits, hits.c.id == Project.id)
+        g.project_search_hits = hits
+        return query, count_query, joins, count_joins
+
+    def _apply_sorting(self, query, joins, sort_column, sort_desc):
+        hits = g.pop('project_search_hits', None)
+        if hits is not None and sort_column is None:
+            query = query.order_by(hits.c.rank)
+        return super(SWProjectView, self)._apply_sorting(query, joins, sort_column, sort_desc)
     column_filters = [
-       'submitted_at', 'teams', 'name', 'project_name',
+       'submitted_at',
+       FilterReference(column=Project.team_id, name='Team', options=team_options),
+       FilterReference(column=Project.owner_id, name='Developer', options=developer_options),
+       'project_name',
        FilterApprove(column=Project.approve, name='Approve Status',
                             options=(('1', 'Approved'), ('2', 'Open')))
     ]
       
+    def _get_filter_groups(self):
+        groups = super(SWProjectView, self)._get_filter_groups()
+        for label, filters in (groups or {}).items():
+            for item in filters:
+                flt = self._filters[item['index']]
+                if isinstance(flt, FilterReference):
+                    item['options'] = flt.get_request_options()
+        return groups
+
     # Automatically store the developers' name and team when creating project
     form_excluded_columns = ('name', 'teams')
     def on_model_change(self, form, model, is_created):
         if is_created:
             model.name = current_user.first_name
+            model.owner_id = current_user.id
             model.teams = current_user.teams.name
+            model.team_id = current_user.teams.id
         if not is_created:    
             model.last_editor = current_user.first_name
             #model.updated_on = datetime.datetime.now          
+        model.review_stage = review_stage_of(model)
+        queue_notifications(self.session, model, is_created)
+
+    # The project's files are listed on the edit page
+    edit_template = 'project_edit.html'
+
+    def artifact_file_view(self):
+        for view in self.admin._views:
+            if isinstance(view, FileView):
+                return view
+        return None
+
+    def project_artifacts(self, model):
+        return ProjectArtifact.query.options(joinedload(ProjectArtifact.uploader)) \
+            .filter(ProjectArtifact.project_id == model.id) \
+            .order_by(ProjectArtifact.uploaded_at.desc()).all()
+
+    # Restrict only the project owners can edit the project according to the review order.
+    # Returns the reason the current user can't change the project, None if they can.
+    def review_rule_error(self, model):
+        if user_has_role('developer'):
+            if model.owner_id != current_user.id:
+              return 'You are not the project owner!'
+        if user_has_role('reviewer1'):
+            if model.reviewer1_id != current_user.id:
+              return 'You are not the project owner!'
+        if user_has_role('reviewer2'):
+           if model.review1 == None or model.review1 ==0:
+              return 'You are not the current approver!'
+           if model.reviewer2_id != current_user.id:
+              return 'You are not the project owner!'
+        if user_has_role('superuser'):
+           if model.review1 == None or model.review1 ==0 or model.review2 == None or model.review2 ==0:
+              return 'You are not the current approver!'
+        if user_has_role('administrator'):
+              return 'You are not the project owner!'
+        return None
 
-    # Restrict only the project owners can edit the project according to the review order
     def update_model(self, form, model):
         form.populate_obj(model)
-        if current_user.has_role('developer'):
-            if model.name != current_user.first_name:
-              flash('You are not the project owner!', 'error')
-              return    
-            else: 
-              flash('Notes updated!', 'message')
-        if current_user.has_role('reviewer1'):
-            if model.reviewer1 != current_user.first_name:
-              flash('You are not the project owner!', 'error')
-              return    
-            else: 
-              flash('Review updated!', 'message')
-        if current_user.has_role('reviewer2'):
-           if model.review1 == None or model.review1 ==0:
-              flash('You are not the current approver!', 'error')
-              return
-           else:
-            if model.reviewer2 != current_user.first_name:
-              flash('You are not the project owner!', 'error')
-              return    
-            else: 
-              flash('Review updated!', 'message')
-        if current_user.has_role('superuser'):
-           if model.review1 == None or model.review1 ==0 or model.review2 == None or model.review2 ==0:
-              flash('You are not the current approver!', 'error')
-              return
-           else:
-              flash('Review updated!', 'message')
-        if current_user.has_role('administrator'):
-              flash('You are not the project owner!', 'error')
-              return
+        error = self.review_rule_error(model)
+        if error:
+            flash(error, 'error')
+            return
+        if user_has_role('developer'):
+            flash('Notes updated!', 'message')
+        else:
+            flash('Review updated!', 'message')
         self.session.add(model)
         self._on_model_change(form, model, False)
         self.session.commit()
 
-     
-    def is_accessible(self):
-        if not current_user.is_active or not current_user.is_authenticated:
-            return False
-        #else:
-            #return True      
+    # Bulk review actions. Every selected project goes through the same
+    # checks as the edit form; the allowed ones are changed in a single
+    # transaction and each skipped one is reported with its reason.
+    def is_action_allowed(self, name):
+        if name == 'mark_reviewed':
+            return user_has_role('reviewer1', 'reviewer2')
+        if name == 'approve':
+            return user_has_role('superuser')
+        return super(SWProjectView, self).is_action_allowed(name)
+
+    @action('mark_reviewed', 'Mark reviewed', 'Mark the selected projects as reviewed?')
+    def action_mark_reviewed(self, ids):
+        if user_has_role('reviewer1'):
+            self._bulk_review(ids, 'review1')
+        elif user_has_role('reviewer2'):
+            self._bulk_review(ids, 'review2')
+
+    @action('approve', 'Approve selected', 'Give final approval to the selected projects?')
+    def action_approve(self, ids):
+        if user_has_role('superuser'):
+            self._bulk_review(ids, 'approve')
+
+    def _bulk_review(self, ids, field):
+        try:
+            projects = self.get_query().filter(Project.id.in_([int(pk) for pk in ids])) \
+                .order_by(Project.id).with_for_update().all()
+            updated = 0
+            skipped = []
+            for project in projects:
+                if project.approve:
+                    error = 'Project is already approved.'
+                elif getattr(project, field):
+                    error = 'Already done.'
+                else:
+                    error = self.review_rule_error(project)
+                if error:
+                    skipped.append((project, error))
+                    continue
+                setattr(project, field, True)
+                self._on_model_change(None, project, False)
+                updated += 1
+            self.session.commit()
+        except Exception as ex:
+            if not self.handle_view_exception(ex):
+                raise
+            self.session.rollback()
+            flash('Failed to update the projects. %s' % str(ex), 'error')
+            return
+
+        missing = len(ids) - len(projects)
+        if updated:
+            flash('%d project(s) updated.' % updated, 'message')
+        if skipped or missing:
+            rows = Markup('').join(Markup('<li>#%d %s %s: %s</li>') % (
+                project.id, project.project_name or '', project.version or '', error)
+                for project, error in skipped)
+            if missing:
+                rows += Markup('<li>%d project(s) not found.</li>') % missing
+            flash(Markup('%d project(s) skipped:<ul>%s</ul>') % (len(skipped) + missing, rows), 'error')
+
+    # Permissions per role, the first role the user has wins
+    can_edit = RequestPermission('can_edit')
+    can_create = RequestPermission('can_create')
+    can_delete = RequestPermission('can_delete')
+    role_permissions = (
+        ('developer', dict(can_edit=True, can_create=True, can_delete=False)),
+        ('reviewer1', dict(can_edit=True, can_create=False, can_delete=False)),
+        ('reviewer2', dict(can_edit=True, can_create=False, can_delete=False)),
+        ('superuser', dict(can_edit=True, can_create=False, can_delete=False)),
+        ('administrator', dict(can_edit=True, can_create=False, can_delete=True)),
+        ('visitor', dict(can_edit=False, can_create=False, can_delete=False)),
+    )
 
-        if current_user.has_role('developer'):
-            self.can_edit = True
-            self.can_create = True
-            self.can_delete = False
-            return True
-        if current_user.has_role('reviewer1'):
-            self.can_edit = True
-            self.can_create = False
-            self.can_delete = False
-            return True       
-        if  current_user.has_role('reviewer2') or current_user.has_role('superuser'):
-            self.can_edit = True
-            self.can_create = False
-            self.can_delete = False
-            return True
-        if  current_user.has_role('administrator'):
-            self.can_edit = True
-            self.can_create = False
-            self.can_delete = True
-            return True
-        if  current_user.has_role('visitor'):
-            self.can_edit = False
-            self.can_create = False
-            self.can_delete = False
-            return True
-        return False
+    # The form rule sets are built once per view; each request only picks the
+    # edit rule set of the user's role. The first role the user has wins.
+    edit_rules_roles = ('superuser', 'administrator', 'developer', 'reviewer2', 'reviewer1')
+
+    def _rulesets(self):
+        rulesets = self.__dict__.get('_cached_rulesets')
+        if rulesets is None:
+            rulesets = dict((role, rules.RuleSet(self, self._build_edit_rules(role)))
+                            for role in self.edit_rules_roles)
+            rulesets['create'] = rules.RuleSet(self, self.create_form_rules)
+            self._cached_rulesets = rulesets
+        return rulesets
+
+    def _edit_rules_role(self):
+        if has_request_context():
+            for role in self.edit_rules_roles:
+                if user_has_role(role):
+                    return role
+        return 'superuser'
 
     @property
     def _form_edit_rules(self):
-        return rules.RuleSet(self, self.edit_form_rules)
+        return self._rulesets()[self._edit_rules_role()]
 
     @_form_edit_rules.setter
     def _form_edit_rules(self, value):
@@ -558,16 +1458,15 @@ class SWProjectView(sqla.ModelView):
 
     @property
     def _form_create_rules(self):
-        return rules.RuleSet(self, self.create_form_rules)
+        return self._rulesets()['create']
 
     @_form_create_rules.setter
     def _form_create_rules(self, value):
         pass
 
-    @property
-    def edit_form_rules(self):
+    def _build_edit_rules(self, role):
        
-        if not has_app_context() or current_user.has_role('reviewer1'):
+        if role == 'reviewer1':
          edit_form_rules = [        
             #rules.Header('Personal Info'),
             rules.Header('Project Info'),
@@ -594,7 +1493,7 @@ class SWProjectView(sqla.ModelView):
             }),
           ]
          
-        if not has_app_context() or current_user.has_role('reviewer2'):
+        if role == 'reviewer2':
          edit_form_rules = [        
             #rules.Header('Personal Info'),
             rules.Header('Project Info'),
@@ -617,7 +1516,7 @@ class SWProjectView(sqla.ModelView):
             }),
          ]
  
-        if not has_app_context() or current_user.has_role('developer'):
+        if role == 'developer':
          edit_form_rules = [        
             #rules.Header('Personal Info'),
             rules.Header('Project Info'),
@@ -644,7 +1543,7 @@ class SWProjectView(sqla.ModelView):
             }),
          ]
        
-        if not has_app_context() or current_user.has_role('superuser') or current_user.has_role('administrator'):
+        if role in ('superuser', 'administrator'):
          edit_form_rules = [        
             #rules.Header('Personal Info'),
             rules.Header('Project Info'),
@@ -683,41 +1582,1304 @@ class SWProjectView(sqla.ModelView):
         return create_form_rules
 
 #Inherit FileAdmin
-class FileView(FileAdmin):
+class FileView(RolePermissionMixin, FileAdmin):
     #can_delete = False
 
+    # Permissions per role, the first role the user has wins
+    can_rename = RequestPermission('can_rename')
+    can_mkdir = RequestPermission('can_mkdir')
+    can_delete = RequestPermission('can_delete')
+    can_upload = RequestPermission('can_upload')
+    role_permissions = (
+        ('administrator', dict(can_rename=False, can_mkdir=True, can_delete=False, can_upload=False)),
+        ('superuser', dict(can_rename=False, can_mkdir=True, can_delete=False, can_upload=False)),
+        ('reviewer2', dict(can_rename=False, can_mkdir=True, can_delete=False, can_upload=False)),
+        ('developer', dict(can_rename=False, can_mkdir=False, can_delete=False, can_upload=True)),
+        ('reviewer1', dict(can_rename=False, can_mkdir=False, can_delete=False, can_upload=True)),
+        ('visitor', dict(can_rename=False, can_mkdir=False, can_delete=False, can_upload=False)),
+    )
+
+    list_template = 'file_list.html'
+
+    # The view's own state (uploads in progress, blobs, previews, document
+    # index) lives in state_path, outside the directory served as /static/.
+    # Keep it on the same filesystem as the base path: the blob store needs
+    # hard links and finished uploads are moved in with a rename.
+    def __init__(self, base_path, *args, **kwargs):
+        self.state_path = kwargs.pop('state_path')
+        super(FileView, self).__init__(base_path, *args, **kwargs)
+        try:
+            os.makedirs(self.state_path)
+        except OSError:
+            pass
+
+    def _state_dir(self, name):
+        directory = op.join(self.state_path, name)
+        try:
+            os.mkdir(directory)
+        except OSError:
+            pass
+        return directory
+
+    # Chunked, resumable uploads. The parts are streamed into the uploads
+    # directory of the state path in small blocks, every chunk is checked
+    # against its SHA-256, and the complete file is renamed into the target
+    # directory. Uploads left unfinished for CHUNKED_UPLOAD_EXPIRY seconds
+    # are removed when the next upload starts.
+    chunk_size = 4 * 1024 * 1024
+    max_chunk_size = 16 * 1024 * 1024
+    chunk_buffer_size = 64 * 1024
+
+    def _upload_dir(self):
+        return self._state_dir('uploads')
+
+    def _expire_uploads(self):
+        expiry = current_app.config.get('CHUNKED_UPLOAD_EXPIRY', 24 * 60 * 60)
+        if expiry is None:
+            return
+        upload_dir = self._upload_dir()
+        last_write = {}
+        for entry in os.scandir(upload_dir):
+            upload_id, ext = op.splitext(entry.name)
+            if ext not in ('.part', '.json'):
+                continue
+            try:
+                mtime = entry.stat().st_mtime
+            except OSError:
+                continue
+            last_write[upload_id] = max(mtime, last_write.get(upload_id, mtime))
+        cutoff = time.time() - expiry
+        for upload_id, mtime in last_write.items():
+            if mtime < cutoff:
+                for ext in ('.part', '.json'):
+                    try:
+                        os.remove(op.join(upload_dir, upload_id + ext))
+                    except OSError:
+                        pass
+
+    def _load_upload(self, upload_id):
+        if not re.match(r'^[0-9a-f]{32}$', upload_id):
+            abort(404)
+        part = op.join(self._upload_dir(), upload_id + '.part')
+        meta = op.join(self._upload_dir(), upload_id + '.json')
+        if not op.exists(meta):
+            abort(404)
+        with open(meta) as f:
+            info = json.load(f)
+        if info['user_id'] != current_user.id:
+            abort(403)
+        info['received'] = op.getsize(part)
+        return part, meta, info
+
+    def _upload_status(self, upload_id, info):
+        return dict(upload_id=upload_id, filename=info['filename'], size=info['size'],
+                    received=info['received'], chunk_size=self.chunk_size)
+
+    @flask_admin.expose('/chunked/')
+    @flask_admin.expose('/chunked/<path:path>')
+    def chunked_upload(self, path=None):
+        base_path, directory, path = self._normalize_path(path)
+        if not self.can_upload or not self.is_accessible_path(path):
+            abort(403)
+        return self.render('chunked_upload.html', dir_path=path,
+                           dir_url=self._get_dir_url('.index_view', path),
+                           start_url=self._get_dir_url('.chunked_upload_start', path))
+
+    @flask_admin.expose('/chunked/start/', methods=('POST',))
+    @flask_admin.expose('/chunked/start/<path:path>', methods=('POST',))
+    def chunked_upload_start(self, path=None):
+        directory, path = self._upload_directory(path)
+        if not self.can_upload or not self.is_accessible_path(path):
+            abort(403)
+
+        data = request.get_json(silent=True) or request.form
+        filename = secure_filename(data.get('filename') or '')
+        try:
+            size = int(data.get('size'))
+        except (TypeError, ValueError):
+            size = -1
+        if not filename or size < 0 or not self.is_file_allowed(filename):
+            return jsonify(error='Invalid file name or size.'), 400
+        if self.storage.path_exists(op.join(directory, filename)):
+            return jsonify(error='File "%s" already exists.' % filename), 409
+
+        self._expire_uploads()
+        upload_id = uuid.uuid4().hex
+        info = dict(filename=filename, size=size, path=path, user_id=current_user.id)
+        open(op.join(self._upload_dir(), upload_id + '.part'), 'wb').close()
+        with open(op.join(self._upload_dir(), upload_id + '.json'), 'w') as f:
+            json.dump(info, f)
+        info['received'] = 0
+        return jsonify(**self._upload_status(upload_id, info))
+
+    @flask_admin.expose('/chunked/part/<upload_id>', methods=('GET', 'PUT', 'DELETE'))
+    def chunked_upload_part(self, upload_id):
+        if not self.can_upload:
+            abort(403)
+        part, meta, info = self._load_upload(upload_id)
+
+        if request.method == 'GET':
+            return jsonify(**self._upload_status(upload_id, info))
+
+        if request.method == 'DELETE':
+            os.remove(part)
+            os.remove(meta)
+            return jsonify(upload_id=upload_id, cancelled=True)
+
+        # A chunk may start anywhere up to the bytes received so far, so a
+        # chunk interrupted half way is simply sent again
+        offset = request.args.get('offset', type=int)
+        if offset is None or offset < 0 or offset > info['received']:
+            return jsonify(error='Chunk must start at or before byte %d.' % info['received'],
+                           **self._upload_status(upload_id, info)), 409
+        expected = request.headers.get('X-Chunk-SHA256')
+        if not expected:
+            return jsonify(error='Missing X-Chunk-SHA256 header.',
+                           **self._upload_status(upload_id, info)), 400
+
+        checksum = hashlib.sha256()
+        written = 0
+        with open(part, 'r+b') as f:
+            f.seek(offset)
+            while True:
+                block = request.stream.read(self.chunk_buffer_size)
+                if not block:
+                    break
+                written += len(block)
+                if written > self.max_chunk_size or offset + written > info['size']:
+                    f.truncate(offset)
+                    return jsonify(error='Chunk too large.'), 413
+                checksum.update(block)
+                f.write(block)
+
+            if checksum.hexdigest() != expected.lower():
+                f.truncate(offset)
+                info['received'] = offset
+                return jsonify(error='Chunk checksum mismatch.',
+                               **self._upload_status(upload_id, info)), 400
+            f.truncate(offset + written)
+
+        info['received'] = offset + written
+        return jsonify(**self._upload_status(upload_id, info))
+
+    @flask_admin.expose('/chunked/finish/<upload_id>', methods=('POST',))
+    def chunked_upload_finish(self, upload_id):
+        if not self.can_upload:
+            abort(403)
+        part, meta, info = self._load_upload(upload_id)
+        if info['received'] != info['size']:
+            return jsonify(error='Upload is incomplete.', **self._upload_status(upload_id, info)), 409
+
+        expected = (request.get_json(silent=True) or request.form).get('sha256')
+        if expected:
+            checksum = hashlib.sha256()
+            with open(part, 'rb') as f:
+                for block in iter(lambda: f.read(self.chunk_buffer_size), b''):
+                    checksum.update(block)
+            if checksum.hexdigest() != expected.lower():
+                return jsonify(error='File checksum mismatch.'), 400
+
+        directory, path = self._upload_directory(info['path'] or None)
+        if self.project_folder_id(path) is not None:
+            self._make_project_folder(directory)
+        target = op.join(directory, info['filename'])
+        if self.storage.path_exists(target):
+            return jsonify(error='File "%s" already exists.' % info['filename']), 409
+
+        with open(part, 'rb') as f:
+            os.fsync(f.fileno())
+        move_into_place(part, target)
+        os.remove(meta)
+        self.on_file_upload(directory, path, target)
+        return jsonify(filename=info['filename'], size=info['size'],
+                       url=self._get_dir_url('.index_view', path or None))
+
+    # Uploads go into the content-addressed blob store; deleting the last
+    # file that references a blob removes the blob
+    def blob_store(self):
+        store = self.__dict__.get('_blob_store')
+        if store is None:
+            store = self._blob_store = BlobStore(self._state_dir('blobs'))
+        return store
+
+    def on_file_upload(self, directory, path, filename):
+        digest = self.blob_store().absorb(filename)
+        rel_path = op.join(path, op.basename(filename)) if path else op.basename(filename)
+        self.artifact_index().remember(rel_path, filename, digest)
+        self.listing_cache().add(directory, op.basename(filename))
+        self.link_artifact(rel_path, filename, digest, current_user.id)
+        self.index_document(rel_path, filename, digest)
+
+    def on_mkdir(self, parent_dir, dir_name):
+        self.listing_cache().add(parent_dir, dir_name)
+
+    def on_rename(self, full_path, dir_base, filename):
+        self.listing_cache().remove(dir_base, op.basename(full_path))
+        self.listing_cache().forget(full_path)
+        self.listing_cache().add(dir_base, filename)
+        self.unlink_artifacts(op.relpath(full_path, self.get_base_path()))
+        self.artifact_index().forget(op.relpath(full_path, self.get_base_path()))
+        self.link_existing_artifacts(op.join(dir_base, filename))
+
+    def before_file_delete(self, full_path, filename):
+        rel_path = op.relpath(full_path, self.get_base_path())
+        g.deleted_blob = self.artifact_index().etag(rel_path, full_path)
+
+    def on_file_delete(self, full_path, filename):
+        digest = getattr(g, 'deleted_blob', None)
+        if digest is not None:
+            self.blob_store().release(digest)
+        self.listing_cache().remove(op.dirname(full_path), op.basename(full_path))
+        self.unlink_artifacts(op.relpath(full_path, self.get_base_path()))
+        self.artifact_index().forget(op.relpath(full_path, self.get_base_path()))
+        self.document_index().remove(op.relpath(full_path, self.get_base_path()))
+
+    # Only the blobs of the files in the deleted directory can have lost
+    # their last reference
+    def before_directory_delete(self, full_path, dir_name):
+        base_path = self.get_base_path()
+        digests = set()
+        for directory, dirs, files in os.walk(full_path):
+            for name in files:
+                path = op.join(directory, name)
+                digests.add(self.artifact_index().etag(op.relpath(path, base_path), path))
+        g.deleted_blobs = digests
+
+    def on_directory_delete(self, full_path, dir_name):
+        for digest in getattr(g, 'deleted_blobs', ()):
+            self.blob_store().release(digest)
+        self.listing_cache().remove(op.dirname(full_path), op.basename(full_path))
+        self.listing_cache().forget(full_path)
+        self.unlink_artifacts(op.relpath(full_path, self.get_base_path()))
+        self.artifact_index().forget(op.relpath(full_path, self.get_base_path()))
+        self.document_index().remove_tree(op.relpath(full_path, self.get_base_path()))
+
+    # Files under projects/<project id>/ are linked to the project in the
+    # ProjectArtifact table. Only the project's developer, its reviewers and
+    # the superusers/administrators may upload there; the folder of a project
+    # is created with its first upload.
+    artifact_prefix = 'projects'
+
+    def project_folder(self, project_id):
+        return self._separator.join([self.artifact_prefix, str(project_id)])
+
+    # Project id of a path in a project folder (the folder itself included)
+    def project_folder_id(self, rel_path):
+        parts = (rel_path or '').replace(os.sep, '/').strip('/').split('/')
+        if len(parts) >= 2 and parts[0] == self.artifact_prefix and parts[1].isdigit():
+            return int(parts[1])
+        return None
+
+    def artifact_project_id(self, rel_path):
+        project_id = self.project_folder_id(rel_path)
+        if project_id is None or len(rel_path.replace(os.sep, '/').strip('/').split('/')) < 3:
+            return None
+        return db.session.query(Project.id).filter(Project.id == project_id).scalar()
+
+    def may_attach(self, project):
+        if project is None or not current_user.is_authenticated:
+            return False
+        if user_has_role('superuser', 'administrator'):
+            return True
+        return current_user.id in (project.owner_id, project.reviewer1_id, project.reviewer2_id)
+
+    # Directory an upload into path goes to. A project folder the user may
+    # not attach files to is refused; one that doesn't exist yet is returned
+    # anyway and created by the upload.
+    def _upload_directory(self, path):
+        project_id = self.project_folder_id(path)
+        if project_id is not None:
+            if not self.may_attach(Project.query.get(project_id)):
+                abort(403)
+            if path.strip(self._separator) == self.project_folder(project_id):
+                return op.join(self.get_base_path(), self.artifact_prefix, str(project_id)), \
+                    self.project_folder(project_id)
+        base_path, directory, path = self._normalize_path(path)
+        return directory, path
+
+    def _make_project_folder(self, directory):
+        if not op.isdir(directory):
+            parent = op.dirname(directory)
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+            self.listing_cache().add(op.dirname(parent), op.basename(parent))
+            self.listing_cache().add(parent, op.basename(directory))
+
+    def _save_form_files(self, directory, path, form):
+        project_id = self.project_folder_id(path)
+        if project_id is not None and not self.may_attach(Project.query.get(project_id)):
+            raise Exception('You are not the owner or a reviewer of project %d.' % project_id)
+        super(FileView, self)._save_form_files(directory, path, form)
+
+    @flask_admin.expose('/chunked/project/<int:project_id>')
+    def project_chunked_upload(self, project_id):
+        project = Project.query.get_or_404(project_id)
+        if not self.can_upload or not self.may_attach(project):
+            abort(403)
+        path = self.project_folder(project_id)
+        return self.render('chunked_upload.html', dir_path=path,
+                           dir_url=admin_helpers.get_redirect_target() or self.get_url('.index_view'),
+                           start_url=self._get_dir_url('.chunked_upload_start', path))
+
+    def link_artifact(self, rel_path, full_path, digest, uploader_id=None):
+        project_id = self.artifact_project_id(rel_path)
+        if project_id is None:
+            return None
+        if uploader_id is not None and not self.may_attach(Project.query.get(project_id)):
+            return None
+        key = rel_path.replace(os.sep, '/')
+        artifact = ProjectArtifact.query.filter(ProjectArtifact.path == key).first() \
+            or ProjectArtifact(path=key)
+        artifact.project_id = project_id
+        artifact.size = os.stat(full_path).st_size
+        artifact.sha256 = digest
+        artifact.uploader_id = uploader_id
+        artifact.uploaded_at = datetime.datetime.now()
+        db.session.add(artifact)
+        db.session.commit()
+        return artifact
+
+    def unlink_artifacts(self, rel_path):
+        key = rel_path.replace(os.sep, '/').rstrip('/')
+        ProjectArtifact.query.filter(or_(ProjectArtifact.path == key,
+                                         ProjectArtifact.path.startswith(key + '/', autoescape=True))) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+
+    # Link the files already in the project folders (under top, default the
+    # base path) that have no ProjectArtifact row yet
+    def link_existing_artifacts(self, top=None):
+        base_path = self.get_base_path()
+        top = top or base_path
+        if not op.isdir(top):
+            rel_path = op.relpath(top, base_path)
+            if self.artifact_project_id(rel_path) is not None:
+                self.link_artifact(rel_path, top, self.artifact_index().etag(rel_path, top))
+            return 0
+
+        if top == base_path:
+            top = op.join(base_path, self.artifact_prefix)
+        linked = set(path for path, in db.session.query(ProjectArtifact.path))
+        project_ids = set(pk for pk, in db.session.query(Project.id))
+        artifacts = []
+        for directory, dirs, files in os.walk(top):
+            for name in files:
+                full_path = op.join(directory, name)
+                rel_path = op.relpath(full_path, base_path)
+                key = rel_path.replace(os.sep, '/')
+                project_id = self.project_folder_id(key)
+                if key in linked or project_id not in project_ids or key.count('/') < 2:
+                    continue
+                stat = os.stat(full_path)
+                artifacts.append(dict(project_id=project_id, path=key, size=stat.st_size,
+                                      sha256=self.artifact_index().etag(rel_path, full_path),
+                                      uploaded_at=datetime.datetime.fromtimestamp(stat.st_mtime)))
+        if artifacts:
+            db.session.bulk_insert_mappings(ProjectArtifact, artifacts)
+            db.session.commit()
+        return len(artifacts)
+
+    # Directory listings come from the listing cache and are paginated, so a
+    # page load on a directory with thousands of artifacts is one stat of
+    # the directory instead of a listdir and a stat per file
+    list_page_size = 100
+
+    def listing_cache(self):
+        cache = self.__dict__.get('_listing_cache')
+        if cache is None:
+            cache = self._listing_cache = DirectoryListingCache(self.get_base_path(),
+                                                                self.is_accessible_path)
+        return cache
+
+    @flask_admin.expose('/')
+    @flask_admin.expose('/b/<path:path>')
+    def index_view(self, path=None):
+        if self.can_delete:
+            delete_form = self.delete_form()
+        else:
+            delete_form = None
+
+        base_path, directory, path = self._normalize_path(path)
+        if not self.is_accessible_path(path):
+            flash('Permission denied.', 'error')
+            return redirect(self._get_dir_url('.index_view'))
+
+        sort_column = request.args.get('sort', None, type=str) or self.default_sort_column
+        sort_desc = request.args.get('desc', 0, type=int) or self.default_desc
+        if sort_column not in self.possible_columns:
+            sort_column = None
+        column = self.possible_columns.index(sort_column) if sort_column else None
+        listing = self.listing_cache().listing(directory, column, bool(sort_desc))
+
+        num_pages = max(1, (len(listing) + self.list_page_size - 1) // self.list_page_size)
+        page = min(max(request.args.get('page', 0, type=int), 0), num_pages - 1)
+        items = listing[page * self.list_page_size:(page + 1) * self.list_page_size]
+
+        if directory != base_path:
+            parent_path = op.normpath(self._separator.join([path, '..']))
+            if parent_path == '.':
+                parent_path = None
+            items.insert(0, ('..', parent_path, True, 0, 0))
+
+        actions, actions_confirmation = self.get_actions_list()
+        if actions:
+            action_form = self.action_form()
+        else:
+            action_form = None
+
+        def sort_url(column, path, invert=False):
+            desc = None
+            if invert and not sort_desc:
+                desc = 1
+            return self.get_url('.index_view', path=path or None, sort=column, desc=desc)
+
+        def pager_url(p):
+            return self.get_url('.index_view', path=path or None, sort=sort_column,
+                                desc=sort_desc or None, page=p or None)
+
+        return self.render(self.list_template,
+                           dir_path=path,
+                           breadcrumbs=self._get_breadcrumbs(path),
+                           get_dir_url=self._get_dir_url,
+                           get_file_url=self._get_file_url,
+                           items=items,
+                           actions=actions,
+                           actions_confirmation=actions_confirmation,
+                           action_form=action_form,
+                           delete_form=delete_form,
+                           sort_column=sort_column,
+                           sort_desc=sort_desc,
+                           sort_url=sort_url,
+                           page=page,
+                           num_pages=num_pages,
+                           pager_url=pager_url,
+                           timestamp_format=self.timestamp_format)
+
+    # Text of the uploaded docx/pdf files is extracted by a process pool, off
+    # the request threads, into an FTS5 index in the state path
+    indexable_extensions = ('.docx', '.pdf')
+
+    def document_index(self):
+        index = self.__dict__.get('_document_index')
+        if index is None:
+            index = self._document_index = DocumentIndex(
+                op.join(self.state_path, 'document-index.sqlite'))
+        return index
+
+    def document_pool(self):
+        pool = self.__dict__.get('_document_pool')
+        if pool is None:
+            pool = self._document_pool = ProcessPoolExecutor(
+                current_app.config.get('DOCUMENT_INDEX_WORKERS', 2))
+        return pool
+
+    def index_document(self, rel_path, full_path, digest):
+        if op.splitext(full_path)[1].lower() not in self.indexable_extensions:
+            return
+        index = self.document_index()
+        if index.is_indexed(rel_path, digest):
+            return
+        logger = current_app.logger
+
+        def store(future):
+            try:
+                index.store(rel_path, digest, future.result())
+            except Exception:
+                logger.exception('Indexing %s failed', rel_path)
+
+        self.document_pool().submit(extract_document_text, full_path).add_done_callback(store)
+
+    # Queue the documents already on disk that aren't indexed yet
+    def index_existing_documents(self):
+        base_path = self.get_base_path()
+        for directory, dirs, files in os.walk(base_path):
+            for name in files:
+                full_path = op.join(directory, name)
+                rel_path = op.relpath(full_path, base_path)
+                if op.splitext(name)[1].lower() in self.indexable_extensions:
+                    self.index_document(rel_path, full_path,
+                                        self.artifact_index().etag(rel_path, full_path))
+
+    @flask_admin.expose('/search/')
+    def search(self):
+        query = request.args.get('q', '').strip()
+        results = []
+        if query:
+            results = [(path, snippet) for path, snippet in self.document_index().search(query)
+                       if self.is_accessible_path(path.replace('/', self._separator))]
+        return self.render('file_search.html', query=query, results=results,
+                           get_file_url=self._get_file_url)
+
+    # Downloads are served here instead of redirecting to /static/: a strong
+    # ETag from the artifact index answers If-None-Match with a 304, Range
+    # requests get partial content, and with ARTIFACT_OFFLOAD set the body is
+    # left to the front-end server (X-Sendfile or nginx X-Accel-Redirect).
+    def artifact_index(self):
+        index = self.__dict__.get('_artifact_index')
+        if index is None:
+            index = self._artifact_index = ArtifactHashIndex()
+        return index
+
+    @flask_admin.expose('/download/<path:path>')
+    def download(self, path=None):
+        if not self.can_download:
+            abort(404)
+        base_path, directory, path = self._normalize_path(path)
+        if not self.is_accessible_path(path) or self.storage.is_dir(directory):
+            abort(404)
+
+        etag = self.artifact_index().etag(path, directory)
+        if etag in request.if_none_match:
+            response = current_app.response_class(status=304)
+        else:
+            offload = current_app.config.get('ARTIFACT_OFFLOAD')
+            mimetype = mimetypes.guess_type(directory)[0] or 'application/octet-stream'
+            if offload == 'x-accel':
+                response = current_app.response_class(mimetype=mimetype)
+                response.headers['X-Accel-Redirect'] = current_app.config['ARTIFACT_ACCEL_PREFIX'] + \
+                    quote(path.replace(os.sep, '/'))
+            elif offload == 'x-sendfile':
+                response = current_app.response_class(mimetype=mimetype)
+                response.headers['X-Sendfile'] = directory
+            else:
+                response = send_file(directory, mimetype=mimetype, add_etags=False, conditional=False)
+                response.set_etag(etag)
+                response = response.make_conditional(request, accept_ranges=True,
+                                                     complete_length=op.getsize(directory))
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.max_age = 0
+        response.cache_control.must_revalidate = True
+        return response
+
+    # Thumbnails of the images and first pages of the PDF documents, rendered
+    # on first request into an LRU cache on disk and shown in the file list
+    def preview_cache(self):
+        cache = self.__dict__.get('_preview_cache')
+        if cache is None:
+            cache = self._preview_cache = PreviewCache(
+                self._state_dir('previews'),
+                current_app.config.get('PREVIEW_CACHE_BYTES', 256 * 1024 * 1024))
+        return cache
+
+    def has_preview(self, name):
+        return preview_extension(name) is not None
+
+    @flask_admin.expose('/preview/<path:path>')
+    def preview(self, path=None):
+        if not self.can_download:
+            abort(404)
+        base_path, directory, path = self._normalize_path(path)
+        if not self.is_accessible_path(path) or self.storage.is_dir(directory) \
+                or not self.has_preview(directory):
+            abort(404)
+
+        etag = self.artifact_index().etag(path, directory)
+        if etag in request.if_none_match:
+            response = current_app.response_class(status=304)
+        else:
+            try:
+                preview = self.preview_cache().get(directory, etag,
+                                                   current_app.config.get('PREVIEW_SIZE', 240))
+            except Exception:
+                current_app.logger.exception('Preview of %s failed', path)
+                preview = None
+            if preview is None:
+                abort(404)
+            response = send_file(preview, mimetype=mimetypes.guess_type(preview)[0],
+                                 add_etags=False, conditional=False)
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.max_age = 0
+        response.cache_control.must_revalidate = True
+        return response
+
+# Extension of the preview of an artifact: JPEG for images, PNG for the
+# first page of a PDF; None when there's no preview or the library for it
+# isn't installed
+PREVIEW_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.tif', '.tiff')
+
+def preview_extension(name):
+    ext = op.splitext(name)[1].lower()
+    if ext in PREVIEW_IMAGE_EXTENSIONS and Image is not None:
+        return '.jpg'
+    if ext == '.pdf' and fitz is not None:
+        return '.png'
+    return None
+
+def render_preview(source, target, size):
+    if op.splitext(source)[1].lower() == '.pdf':
+        with fitz.open(source) as document:
+            if not document.page_count:
+                return False
+            page = document[0]
+            zoom = float(size) / max(page.rect.width, page.rect.height)
+            data = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom)).tobytes('png')
+        with open(target, 'wb') as f:
+            f.write(data)
+        return True
+
+    with Image.open(source) as image:
+        # Lets the JPEG decoder scale down while decoding
+        image.draft('RGB', (size, size))
+        image.thumbnail((size, size))
+        image.convert('RGB').save(target, 'JPEG', quality=80, optimize=True)
+    return True
+
+# On-disk cache of the previews, named after the SHA-256 of the artifact and
+# the preview size, so a changed artifact gets a new preview and identical
+# artifacts share one. Serving a preview bumps its mtime; when the cache
+# grows past max_bytes the least recently used previews are evicted down
+# to 90% of it.
+class PreviewCache(object):
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = None
+
+    def get(self, source, digest, size):
+        ext = preview_extension(source)
+        if ext is None:
+            return None
+        target = op.join(self.root, '%s-%d%s' % (digest, size, ext))
+        try:
+            os.utime(target)
+            return target
+        except OSError:
+            pass
+
+        try:
+            os.makedirs(self.root)
+        except OSError:
+            pass
+        tmp = '%s.%s.tmp' % (target, uuid.uuid4().hex)
+        try:
+            if not render_preview(source, tmp, size):
+                return None
+            os.replace(tmp, target)
+        finally:
+            if op.exists(tmp):
+                os.remove(tmp)
+        self._added(os.stat(target).st_size)
+        return target
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _added(self, nbytes):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for mtime, size, path in self._entries())
+            else:
+                self._size += nbytes
+            if self._size <= self.max_bytes:
+                return
+            for mtime, size, path in sorted(self._entries()):
+                if self._size <= self.max_bytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self._size -= size
+
+# Listings of the FileView directories, in FileAdmin's item format
+# (name, rel_path, is_dir, size, mtime). A cached listing is used for as long
+# as the mtime of its directory is unchanged (creating, removing or renaming
+# an entry bumps it) and keeps its sorted orders, so a page load costs one
+# stat. Changes made through the FileView are applied to the cached listing
+# directly instead of rescanning it.
+class DirectoryListingCache(object):
+    def __init__(self, base_path, is_visible, max_directories=256):
+        self.base_path = base_path
+        self.is_visible = is_visible
+        self.max_directories = max_directories
+        self._lock = threading.Lock()
+        self._listings = OrderedDict()
+
+    def _item(self, directory, name, stat, is_dir):
+        return (name, op.relpath(op.join(directory, name), self.base_path),
+                is_dir, stat.st_size, stat.st_mtime)
+
+    def _scan(self, directory):
+        # The mtime is read before the entries: a change made during the
+        # scan leaves the listing stale, never wrongly current
+        listing = dict(mtime=os.stat(directory).st_mtime_ns, items={}, orders={})
+        for entry in os.scandir(directory):
+            try:
+                item = self._item(directory, entry.name, entry.stat(), entry.is_dir())
+            except OSError:
+                continue
+            if self.is_visible(item[1]):
+                listing['items'][entry.name] = item
+        return listing
+
+    # Visible items of the directory; column is an index into the item tuple,
+    # None for directories first, then by name
+    def listing(self, directory, column=None, desc=False):
+        mtime = os.stat(directory).st_mtime_ns
+        with self._lock:
+            listing = self._listings.get(directory)
+            if listing is not None and listing['mtime'] == mtime:
+                self._listings.move_to_end(directory)
+            else:
+                listing = None
+        if listing is None:
+            listing = self._scan(directory)
+            with self._lock:
+                self._listings[directory] = listing
+                self._listings.move_to_end(directory)
+                while len(self._listings) > self.max_directories:
+                    self._listings.popitem(last=False)
+
+        with self._lock:
+            items = listing['orders'].get((column, desc))
+            if items is None:
+                items = list(listing['items'].values())
+                if column is None:
+                    items.sort(key=lambda item: (not item[2], item[0]))
+                else:
+                    items.sort(key=itemgetter(column), reverse=desc)
+                listing['orders'][(column, desc)] = items
+        return items
+
+    # Only a listing that is cached gets updated; the sorted orders are
+    # rebuilt from it on the next page load
+    def _update(self, directory, name, stat=None):
+        with self._lock:
+            listing = self._listings.get(directory)
+            if listing is None:
+                return
+            try:
+                if stat is not None:
+                    item = self._item(directory, name, stat, op.isdir(op.join(directory, name)))
+                    if self.is_visible(item[1]):
+                        listing['items'][name] = item
+                else:
+                    listing['items'].pop(name, None)
+                listing['mtime'] = os.stat(directory).st_mtime_ns
+            except OSError:
+                del self._listings[directory]
+                return
+            listing['orders'] = {}
+
+    def add(self, directory, name):
+        try:
+            stat = os.stat(op.join(directory, name))
+        except OSError:
+            return self.forget(directory)
+        self._update(directory, name, stat)
+
+    def remove(self, directory, name):
+        self._update(directory, name)
+
+    # Drops the listings of the directory and everything below it
+    def forget(self, directory):
+        prefix = op.join(directory, '')
+        with self._lock:
+            for cached in [d for d in self._listings if d == directory or d.startswith(prefix)]:
+                del self._listings[cached]
+
+def file_sha256(path, buffer_size=1024 * 1024):
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(buffer_size), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+# Plain text of a .docx (stdlib only) or .pdf (needs pdfminer.six) file.
+# Runs in the document worker processes.
+WORDML = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+def extract_document_text(path):
+    ext = op.splitext(path)[1].lower()
+    if ext == '.docx':
+        with zipfile.ZipFile(path) as document:
+            root = ElementTree.fromstring(document.read('word/document.xml'))
+        return '\n'.join(''.join(t.text or '' for t in p.iter(WORDML + 't'))
+                         for p in root.iter(WORDML + 'p'))
+    if ext == '.pdf' and pdf_extract_text is not None:
+        return pdf_extract_text(path)
+    return None
+
+# Inverted index of the document text (SQLite FTS5), keyed by the path
+# relative to the FileView base path
+class DocumentIndex(object):
+    snippet_start = u'\x02'
+    snippet_end = u'\x03'
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as connection:
+            connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS document_fts "
+                               "USING fts5(path UNINDEXED, body, tokenize='unicode61')")
+            connection.execute("CREATE TABLE IF NOT EXISTS document "
+                               "(path TEXT PRIMARY KEY, digest TEXT, indexed_at TEXT)")
+
+    @contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def is_indexed(self, rel_path, digest):
+        with self._connect() as connection:
+            row = connection.execute("SELECT digest FROM document WHERE path = ?",
+                                     (rel_path.replace(os.sep, '/'),)).fetchone()
+        return row is not None and row[0] == digest
+
+    def store(self, rel_path, digest, text):
+        key = rel_path.replace(os.sep, '/')
+        with self._connect() as connection:
+            connection.execute("DELETE FROM document_fts WHERE path = ?", (key,))
+            if text:
+                connection.execute("INSERT INTO document_fts (path, body) VALUES (?, ?)", (key, text))
+            connection.execute("INSERT OR REPLACE INTO document (path, digest, indexed_at) "
+                               "VALUES (?, ?, ?)", (key, digest, datetime.datetime.now().isoformat()))
+
+    def remove(self, rel_path):
+        key = rel_path.replace(os.sep, '/')
+        with self._connect() as connection:
+            connection.execute("DELETE FROM document_fts WHERE path = ?", (key,))
+            connection.execute("DELETE FROM document WHERE path = ?", (key,))
+
+    def remove_tree(self, rel_path):
+        prefix = rel_path.replace(os.sep, '/').rstrip('/') + '/%'
+        with self._connect() as connection:
+            connection.execute("DELETE FROM document_fts WHERE path LIKE ?", (prefix,))
+            connection.execute("DELETE FROM document WHERE path LIKE ?", (prefix,))
+
+    # [(path, snippet)] best match first; the snippet is HTML with the
+    # matching words in <mark>
+    def search(self, query, limit=50):
+        terms = fts_query(query)
+        if not terms:
+            return []
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT path, snippet(document_fts, 1, ?, ?, '...', 16) FROM document_fts "
+                "WHERE document_fts MATCH ? ORDER BY rank LIMIT ?",
+                (self.snippet_start, self.snippet_end, terms, limit)).fetchall()
+        return [(path, Markup(escape(snippet)).replace(self.snippet_start, Markup('<mark>'))
+                 .replace(self.snippet_end, Markup('</mark>'))) for path, snippet in rows]
+
+# SHA-256 of the artifacts under a FileView, kept in the artifact_hash table
+# and recomputed only when the size or mtime of a file changes. It uses its
+# own connections, so it never commits the request's session.
+class ArtifactHashIndex(object):
+    table = ArtifactHash.__table__
+
+    def etag(self, rel_path, full_path):
+        key = rel_path.replace(os.sep, '/')
+        stat = os.stat(full_path)
+        t = self.table
+        row = db.engine.execute(db.select([t.c.size, t.c.mtime, t.c.sha256])
+                                .where(t.c.path == key)).fetchone()
+        if row is not None and row.size == stat.st_size and row.mtime == stat.st_mtime:
+            return row.sha256
+        return self.remember(rel_path, full_path, file_sha256(full_path))
+
+    def remember(self, rel_path, full_path, digest):
+        key = rel_path.replace(os.sep, '/')
+        stat = os.stat(full_path)
+        values = dict(size=stat.st_size, mtime=stat.st_mtime, sha256=digest)
+        t = self.table
+        try:
+            with db.engine.begin() as connection:
+                if not connection.execute(t.update().where(t.c.path == key).values(**values)).rowcount:
+                    connection.execute(t.insert().values(path=key, **values))
+        except IntegrityError:
+            # Inserted by another request at the same time
+            pass
+        return digest
+
+    # Drops the file, or the directory and everything below it
+    def forget(self, rel_path):
+        key = rel_path.replace(os.sep, '/').rstrip('/')
+        t = self.table
+        db.engine.execute(t.delete().where(or_(t.c.path == key,
+                                               t.c.path.startswith(key + '/', autoescape=True))))
+
+# Rename a finished file into place; when the source is on another
+# filesystem, copy it next to the target first so the target still appears
+# in one step
+def move_into_place(source, target):
+    try:
+        os.rename(source, target)
+    except OSError:
+        tmp = op.join(op.dirname(target), '.%s.%s.tmp' % (op.basename(target), uuid.uuid4().hex))
+        shutil.copyfile(source, tmp)
+        os.replace(tmp, target)
+        os.remove(source)
+
+# Content-addressed store of the FileView files. Every file is a hard link to
+# <root>/<sha[:2]>/<sha>, so identical uploads share one copy on disk. The
+# link count of a blob is its reference count: a blob only the store still
+# links to is garbage. Where hard links aren't supported the plain copy is kept.
+class BlobStore(object):
+    def __init__(self, root):
+        self.root = root
+
+    def blob_path(self, digest):
+        return op.join(self.root, digest[:2], digest)
+
+    def absorb(self, path, digest=None):
+        digest = digest or file_sha256(path)
+        blob = self.blob_path(digest)
+        try:
+            os.makedirs(op.dirname(blob))
+        except OSError:
+            pass
+        try:
+            try:
+                os.link(path, blob)
+            except FileExistsError:
+                # Same content already stored: point the file at that blob
+                tmp = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+                os.link(blob, tmp)
+                os.replace(tmp, path)
+        except OSError:
+            pass
+        return digest
+
+    def absorb_tree(self, base_path):
+        absorbed = 0
+        for directory, dirs, files in os.walk(base_path):
+            for name in files:
+                path = op.join(directory, name)
+                if os.stat(path).st_nlink == 1:
+                    self.absorb(path)
+                    absorbed += 1
+        return absorbed
+
+    def references(self, digest):
+        try:
+            return os.stat(self.blob_path(digest)).st_nlink - 1
+        except OSError:
+            return 0
+
+    def release(self, digest):
+        if op.exists(self.blob_path(digest)) and self.references(digest) <= 0:
+            os.remove(self.blob_path(digest))
+
+    # Sweep of the whole store, for maintenance (dedupe.py)
+    def collect(self):
+        removed = 0
+        for directory, dirs, files in os.walk(self.root):
+            for name in files:
+                path = op.join(directory, name)
+                if os.stat(path).st_nlink <= 1:
+                    os.remove(path)
+                    removed += 1
+        return removed
+
+# "My queue": the projects waiting on the current reviewer. The list is read
+# from the partial index of its review stage, so it doesn't grow with the
+# number of approved projects.
+class ReviewQueueView(SWProjectView):
+    review_stage = None
+    # Project column holding the reviewer's id, None for a shared queue
+    reviewer_column = None
+
+    def get_query(self):
+        query = super(ReviewQueueView, self).get_query() \
+            .filter(Project.review_stage == self.review_stage)
+        if self.reviewer_column is not None:
+            query = query.filter(getattr(Project, self.reviewer_column) == current_user.id)
+        return query
+
+    def get_count_query(self):
+        query = super(ReviewQueueView, self).get_count_query() \
+            .filter(Project.review_stage == self.review_stage)
+        if self.reviewer_column is not None:
+            query = query.filter(getattr(Project, self.reviewer_column) == current_user.id)
+        return query
+
+class Reviewer1QueueView(ReviewQueueView):
+    review_stage = u'pending_r1'
+    reviewer_column = 'reviewer1_id'
+    role_permissions = (
+        ('reviewer1', dict(can_edit=True, can_create=False, can_delete=False)),
+    )
+
+class Reviewer2QueueView(ReviewQueueView):
+    review_stage = u'pending_r2'
+    reviewer_column = 'reviewer2_id'
+    role_permissions = (
+        ('reviewer2', dict(can_edit=True, can_create=False, can_delete=False)),
+    )
+
+class FinalApprovalQueueView(ReviewQueueView):
+    review_stage = u'pending_final'
+    role_permissions = (
+        ('superuser', dict(can_edit=True, can_create=False, can_delete=False)),
+    )
+
+# Request statistics page, administrator only
+class StatsView(flask_admin.BaseView):
+    sort_keys = ('avg_ms', 'max_ms', 'avg_queries', 'max_queries', 'requests')
+
     def is_accessible(self):
         if not current_user.is_active or not current_user.is_authenticated:
             return False
-           
-        if current_user.has_role('administrator'):
-            self.can_rename = False
-            self.can_mkdir = True
-            self.can_delete = False
-            self.can_upload = False
-            return True
-        if current_user.has_role('superuser') or current_user.has_role('reviewer2'):
-            self.can_rename = False
-            self.can_mkdir = True
-            self.can_delete = False
-            self.can_upload = False
-            return True
-        if current_user.has_role('developer') or current_user.has_role('reviewer1') :
-            self.can_rename = False
-            self.can_mkdir = False
-            self.can_delete = False
-            self.can_upload = True
-            return True
-        if current_user.has_role('visitor'):
-            self.can_rename = False
-            self.can_mkdir = False
-            self.can_delete = False
-            self.can_upload = False
-            return True
-        return False
+        return user_has_role('administrator')
+
+    def _handle_view(self, name, **kwargs):
+        """
+        Override builtin _handle_view in order to redirect users when a view is not accessible.
+        """
+        if not self.is_accessible():
+            if current_user.is_authenticated:
+                # permission denied
+                abort(403)
+            else:
+                # login
+                return redirect(url_for('security.login', next=request.url))
+
+    @flask_admin.expose('/')
+    def index(self):
+        sort = request.args.get('sort')
+        if sort not in self.sort_keys:
+            sort = 'avg_ms'
+        if request.args.get('reset'):
+            request_stats.reset()
+            return redirect(url_for('.index'))
+        return self.render('admin/stats.html', rows=request_stats.worst(sort),
+                           sort=sort, sort_keys=self.sort_keys)
+
+# Reviewer notifications. The request only adds rows to the Notification
+# outbox; a NotificationWorker thread claims them in batches after the
+# commit, renders them and hands them to a thread pool that sends them
+# through the configured transport.
+NOTIFICATION_MESSAGES = {
+    'review1': (u'[RCS] Review requested: {project} {version}',
+                u'Hi {recipient},\n\n{developer} ({team}) submitted {project} {version} '
+                u'and selected you as Reviewer1.\n\nSVN: {svn}\n\nNotes:\n{notes}\n'),
+    'review2': (u'[RCS] Review requested: {project} {version}',
+                u'Hi {recipient},\n\n{project} {version} of {developer} ({team}) passed '
+                u'Reviewer1 and waits for your review.\n\nSVN: {svn}\n\nReviewer1:\n{comment1}\n'),
+    'final': (u'[RCS] Final approval requested: {project} {version}',
+              u'Hi {recipient},\n\n{project} {version} of {developer} ({team}) passed both '
+              u'reviews and waits for the final approval.\n\nSVN: {svn}\n'),
+    'approved': (u'[RCS] Approved: {project} {version}',
+                 u'Hi {recipient},\n\n{project} {version} was approved for release.\n\n{comment3}\n'),
+}
+
+def _became_true(model, name):
+    history = inspect(model).attrs[name].history
+    return bool(history.added and history.added[0]) and not (history.deleted and history.deleted[0])
+
+def queue_notifications(session, model, is_created):
+    recipients = []
+    if is_created:
+        recipients.append(('review1', model.reviewer1_id))
+    elif _became_true(model, 'approve'):
+        recipients.append(('approved', model.owner_id))
+    elif _became_true(model, 'review2'):
+        superusers = session.query(User.id).join(User.roles).filter(Role.name == 'superuser')
+        recipients.extend(('final', pk) for pk, in superusers)
+    elif _became_true(model, 'review1'):
+        recipients.append(('review2', model.reviewer2_id))
+
+    for kind, recipient_id in recipients:
+        if recipient_id is not None:
+            session.add(Notification(kind=kind, project=model, recipient_id=recipient_id))
+    if recipients:
+        session.info['notifications_queued'] = True
+
+@listens_for(Session, 'after_commit')
+def notifications_after_commit(session):
+    if session.info.pop('notifications_queued', False) and has_app_context():
+        worker = current_app.extensions.get('rcs_notifications')
+        if worker is not None:
+            worker.wake()
+
+# Transports: write each message as an .eml file, or send it to an SMTP
+# server (for local testing: python -m smtpd -n -c DebuggingServer localhost:1025)
+class FileTransport(object):
+    def __init__(self, config):
+        self.directory = config['NOTIFY_OUTBOX_DIR']
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            pass
+
+    def send(self, message):
+        name = '%s-%s.eml' % (datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'),
+                              message['X-RCS-Notification'])
+        with open(op.join(self.directory, name), 'w') as f:
+            f.write(message.as_string())
+
+class SMTPTransport(object):
+    def __init__(self, config):
+        self.host = config['NOTIFY_SMTP_HOST']
+        self.port = config['NOTIFY_SMTP_PORT']
+
+    def send(self, message):
+        smtp = smtplib.SMTP(self.host, self.port, timeout=30)
+        try:
+            smtp.sendmail(message['From'], [message['To']], message.as_string())
+        finally:
+            smtp.quit()
+
+notification_transports = {
+    'file': FileTransport,
+    'smtp': SMTPTransport,
+}
+
+# Every row is handled on its own: a notification that can't be rendered or
+# sent is retried later with exponential backoff, and marked 'failed' after
+# NOTIFY_MAX_ATTEMPTS attempts. A claim left in 'sending' by a worker that
+# died counts as a failed attempt too.
+class NotificationWorker(object):
+    # Claims left in 'sending' longer than this (a crashed worker) are retried
+    claim_timeout = timedelta(minutes=10)
+
+    def __init__(self, app):
+        self.app = app
+        self.transport = notification_transports[app.config['NOTIFY_TRANSPORT']](app.config)
+        self.sender = app.config['NOTIFY_SENDER']
+        self.batch_size = app.config['NOTIFY_BATCH_SIZE']
+        self.interval = app.config['NOTIFY_INTERVAL']
+        self.max_attempts = app.config['NOTIFY_MAX_ATTEMPTS']
+        self.retry_delay = app.config['NOTIFY_RETRY_DELAY']
+        self.pool = ThreadPoolExecutor(app.config['NOTIFY_THREADS'])
+        self._wakeup = threading.Event()
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='rcs-notifications')
+        thread.daemon = True
+        thread.start()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def run(self):
+        while True:
+            self.send_pending()
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    # Sends everything that is due; returns the number of rows handled
+    def send_pending(self):
+        handled = 0
+        try:
+            with self.app.app_context():
+                while True:
+                    count = self.drain()
+                    handled += count
+                    if count < self.batch_size:
+                        break
+        except Exception:
+            self.app.logger.exception('Sending notifications failed')
+        return handled
+
+    def recover(self, now):
+        db.session.query(Notification).filter(
+            Notification.status == 'sending',
+            Notification.claimed_at < now - self.claim_timeout,
+        ).update(dict(
+            status=case([(Notification.attempts + 1 >= self.max_attempts, 'failed')], else_='pending'),
+            attempts=Notification.attempts + 1,
+            last_error=u'Claim timed out',
+            next_attempt_at=now,
+        ), synchronize_session=False)
+        db.session.commit()
+
+    def claim(self):
+        now = datetime.datetime.now()
+        self.recover(now)
+        due = and_(Notification.status == 'pending',
+                   or_(Notification.next_attempt_at == None, Notification.next_attempt_at <= now))
+        pending = db.session.query(Notification.id).filter(due) \
+            .order_by(Notification.id).limit(self.batch_size).all()
+
+        claimed = []
+        for pk, in pending:
+            # Another worker process may have claimed it in the meantime
+            if db.session.query(Notification).filter(Notification.id == pk, due) \
+                    .update(dict(status='sending', claimed_at=now), synchronize_session=False):
+                claimed.append(pk)
+        db.session.commit()
+        return claimed
+
+    def render(self, notification):
+        project = notification.project
+        recipient = User.query.get(notification.recipient_id)
+        if project is None or recipient is None:
+            raise LookupError('Project or recipient no longer exists')
+        subject, body = NOTIFICATION_MESSAGES[notification.kind]
+        values = dict(recipient=recipient.first_name, developer=project.name, team=project.teams,
+                      project=project.project_name, version=project.version, svn=project.SVN,
+                      notes=project.notes, comment1=project.comment1 or u'',
+                      comment3=project.comment3 or u'')
+        message = MIMEText(body.format(**values), 'plain', 'utf-8')
+        message['Subject'] = subject.format(**values)
+        message['From'] = self.sender
+        message['To'] = recipient.email
+        message['X-RCS-Notification'] = str(notification.id)
+        return message
+
+    def failed(self, notification, error, now):
+        notification.attempts += 1
+        notification.last_error = error
+        if notification.attempts >= self.max_attempts:
+            notification.status = 'failed'
+        else:
+            notification.status = 'pending'
+            notification.next_attempt_at = now + timedelta(
+                seconds=self.retry_delay * 2 ** (notification.attempts - 1))
+
+    def drain(self):
+        claimed = self.claim()
+        if not claimed:
+            return 0
+        notifications = Notification.query.filter(Notification.id.in_(claimed)) \
+            .options(joinedload(Notification.project)).all()
+
+        now = datetime.datetime.now()
+        messages = []
+        for notification in notifications:
+            try:
+                messages.append((notification, self.render(notification)))
+            except Exception as ex:
+                self.failed(notification, repr(ex), now)
+
+        def send(item):
+            notification, message = item
+            try:
+                self.transport.send(message)
+                return notification, None
+            except Exception as ex:
+                return notification, repr(ex)
+
+        for notification, error in self.pool.map(send, messages):
+            if error is None:
+                notification.status = 'sent'
+                notification.sent_at = now
+            else:
+                self.failed(notification, error, now)
+        db.session.commit()
+        return len(claimed)
+
+# Run the worker in this process; after_commit wakes it up right away
+def start_notification_worker(app):
+    worker = app.extensions['rcs_notifications'] = NotificationWorker(app)
+    worker.start()
+    return worker
 
 # Flask views
-@app.route('/')
 def index():
     return render_template('index.html')
 
@@ -744,39 +2906,97 @@ def index():
 
 
 # Create admin
-admin = flask_admin.Admin(
-    app,
-    'Release Control System',
-    # log in success page
-    base_template='my_master.html',  
-    #base_template='layout.html', 
-    template_mode='bootstrap3',
-)
-
-# Add model views and avoid warnings
-#with warnings.catch_warnings():
-#warnings.filterwarnings('ignore', 'Fields missing from ruleset', UserWarning)
-admin.add_view(AdminModelView(Role, db.session,category='Management'))
-admin.add_view(TeamView(Team, db.session,category='Management'))
-admin.add_view(UserListView(User, db.session, name = "User List", endpoint="users",category='Management'))
-admin.add_view(UserView(User, db.session, name = "User Profile"))
-admin.add_view(SWProjectView(Project, db.session, name = "Project"))
-admin.add_view(FileView(file_path, '/static/', name='File'))
-
-
-# define a context processor for merging flask-admin's template context into the
-# flask-security views.
-@security.context_processor
-def security_context_processor():
-    return dict(
-        admin_base_template=admin.base_template,
-        admin_view=admin.index_view,
-        h=admin_helpers,
-        get_url=url_for
+def create_admin(app):
+    admin = flask_admin.Admin(
+        name='Release Control System',
+        # log in success page
+        base_template='my_master.html',  
+        #base_template='layout.html', 
+        template_mode='bootstrap3',
     )
 
+    # Add model views and avoid warnings
+    #with warnings.catch_warnings():
+    #warnings.filterwarnings('ignore', 'Fields missing from ruleset', UserWarning)
+    admin.add_view(AdminModelView(Role, db.session,category='Management'))
+    admin.add_view(TeamView(Team, db.session,category='Management'))
+    admin.add_view(UserListView(User, db.session, name = "User List", endpoint="users",category='Management'))
+    admin.add_view(UserView(User, db.session, name = "User Profile"))
+    admin.add_view(SWProjectView(Project, db.session, name = "Project"))
+    admin.add_view(Reviewer1QueueView(Project, db.session, name="Reviewer1 queue",
+                                      endpoint='queue_reviewer1', category='My queue'))
+    admin.add_view(Reviewer2QueueView(Project, db.session, name="Reviewer2 queue",
+                                      endpoint='queue_reviewer2', category='My queue'))
+    admin.add_view(FinalApprovalQueueView(Project, db.session, name="Final approval queue",
+                                          endpoint='queue_final', category='My queue'))
+    admin.add_view(FileView(app.config.get('FILE_PATH') or file_path, '/static/', name='File',
+                            state_path=app.config.get('FILE_STATE_PATH')
+                            or op.join(app.instance_path, 'file-state')))
+    admin.add_view(StatsView(name='Request Stats', endpoint='stats', category='Management'))
+    return admin
+
+
+# Create Flask application. Nothing here touches the database: the engine is
+# created but connects only when the first request needs it.
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.from_pyfile('config.py')
+    if config:
+        app.config.update(config)
+
+    log_missing_optional_packages(app)
+
+    db.init_app(app)
+    with app.app_context():
+        install_sqlite_pragmas(app, db.engine)
+        install_slow_query_log(app, db.engine)
+        install_request_stats(app, db.engine)
+
+    # Create directory for file fields to use
+    try:
+        os.mkdir(app.config.get('FILE_PATH') or file_path)
+    except OSError:
+        pass
+
+    # The notification worker is started by the send-notifications command
+    # (or by the development server below), never by the factory, so the
+    # scripts and the WSGI workers building the app don't each poll the outbox
+    @app.cli.command('send-notifications')
+    @click.option('--once', is_flag=True, help='Send what is due and exit.')
+    def send_notifications(once):
+        """Send the reviewer notifications from the outbox."""
+        worker = NotificationWorker(app)
+        if once:
+            click.echo('%d notifications handled' % worker.send_pending())
+        else:
+            worker.run()
+
+    @app.cli.command('upgrade-db')
+    def upgrade_db():
+        """Upgrade the database to the current schema."""
+        unresolved = upgrade_database()
+        click.echo('Database upgraded, %d projects with unresolved references' % unresolved)
+
+    security_state = security.init_app(app, user_datastore)
+    admin = create_admin(app)
+    admin.init_app(app)
+    app.add_url_rule('/', 'index', index)
+
+    # define a context processor for merging flask-admin's template context into the
+    # flask-security views.
+    @security_state.context_processor
+    def security_context_processor():
+        return dict(
+            admin_base_template=admin.base_template,
+            admin_view=admin.index_view,
+            h=admin_helpers,
+            get_url=url_for
+        )
+
+    return app
+
 
-def build_sample_db():
+def build_sample_db(app):
     """
     Populate a small db with some example entries.
     """
@@ -784,10 +3004,10 @@ def build_sample_db():
     import string
     import random
 
-    db.drop_all()
-    db.create_all()
-
     with app.app_context():
+        db.drop_all()
+        db.create_all()
+
         user_role = Role(name='user')
         super_user_role = Role(name='superuser')
         db.session.add(user_role)
@@ -826,13 +3046,24 @@ def build_sample_db():
     return
 
 if __name__ == '__main__':
+    app = create_app()
 
     # Build a sample db on the fly, if one does not exist yet.
     app_dir = os.path.realpath(os.path.dirname(__file__))
     database_path = os.path.join(app_dir, app.config['DATABASE_FILE'])
     if not os.path.exists(database_path):
-        build_sample_db()
+        build_sample_db(app)
+    with app.app_context():
+        upgrade_database()
+        for view in app.extensions['admin'][0]._views:
+            if isinstance(view, FileView):
+                view.index_existing_documents()
+                view.link_existing_artifacts()
+    # With the reloader this module runs twice, in the watcher and in the
+    # server process: only the server process sends the notifications
+    if app.config.get('NOTIFY_ENABLED') and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_notification_worker(app)
 
     # Start app
-    app.run(debug=True)
+    app.run(debug=True, threaded=True)
     #app.run(port=5003,host='0.0.0.0')
\ No newline at end of file
@@ -0,0 +1,195 @@
+"""
+Latency benchmark of the Release Control System hot paths.
+
+    python bench.py [--iterations 50] [--projects 20000] [--output run.json]
+                    [--compare previous.json]
+
+A throw-away SQLite database is seeded with fixtures.py and every scenario
+is driven through the Flask test client. For each scenario the p50/p95/p99
+latency (ms) and the SQL statements per request are reported, and the whole
+run is written as JSON so runs can be compared with --compare.
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from flask import g
+
+import fixtures
+
+PASSWORD = 'password'
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = max(int(round(pct / 100.0 * len(ordered))) - 1, 0)
+    return ordered[index]
+
+
+# SQL statements of the last request, from the request-scoped stats the app
+# keeps on g (REQUEST_STATS_ENABLED). They are read when the request context
+# is torn down, after a streamed body has been sent, so its queries count too.
+class RequestQueries(object):
+    def __init__(self, app):
+        self.last = None
+
+        @app.teardown_request
+        def record_queries(exc):
+            stats = getattr(g, 'request_stats', None)
+            if stats is not None:
+                self.last = stats['queries']
+
+
+class Bench(object):
+    def __init__(self, rcs, app, iterations):
+        self.rcs = rcs
+        self.app = app
+        self.iterations = iterations
+        self.results = {}
+        self.queries = RequestQueries(app)
+
+    def user_email(self, role_name):
+        with self.app.app_context():
+            user = self.rcs.User.query.join(self.rcs.User.roles) \
+                .filter(self.rcs.Role.name == role_name).order_by(self.rcs.User.id).first()
+            return user.email
+
+    def login(self, client, role_name):
+        response = client.post('/admin/login/', data=dict(
+            email=self.user_email(role_name), password=PASSWORD))
+        assert response.status_code == 302, 'login as %s failed' % role_name
+        return client
+
+    def client(self, role_name):
+        return self.login(self.app.test_client(), role_name)
+
+    def measure(self, name, request, expect=(200,)):
+        latencies, queries = [], []
+        for n in range(self.iterations):
+            self.queries.last = None
+            start = time.time()
+            response = request(n)
+            latencies.append((time.time() - start) * 1000)
+            # Drain streamed bodies inside the measurement
+            response.get_data()
+            assert response.status_code in expect, '%s: HTTP %d' % (name, response.status_code)
+            assert self.queries.last is not None, '%s: no request stats' % name
+            queries.append(self.queries.last)
+        self.results[name] = dict(
+            p50_ms=round(percentile(latencies, 50), 2),
+            p95_ms=round(percentile(latencies, 95), 2),
+            p99_ms=round(percentile(latencies, 99), 2),
+            queries_per_request=round(sum(queries) / float(len(queries)), 1),
+            requests=len(latencies),
+        )
+
+    def run(self):
+        rcs = self.rcs
+        developer = self.client('developer')
+        superuser = self.client('superuser')
+
+        with self.app.app_context():
+            admin = self.app.extensions['admin'][0]
+            view = [v for v in admin._views if isinstance(v, rcs.SWProjectView)][0]
+            approve_filter = [i for i, f in enumerate(view._filters)
+                              if isinstance(f, rcs.FilterApprove)][0]
+            project = rcs.Project.query.filter(rcs.Project.review1 == True,
+                                               rcs.Project.review2 == True).first()
+            project_id, edit_data = project.id, dict(
+                project_name=project.project_name, version=project.version,
+                SVN=project.SVN, notes=project.notes, comment1=project.comment1 or '',
+                review1='y', comment2=project.comment2 or '', review2='y')
+
+        self.measure('project_list', lambda n: developer.get('/admin/project/'))
+        self.measure('project_search', lambda n: developer.get(
+            '/admin/project/?search=Project+1'))
+        self.measure('project_filter_approve', lambda n: developer.get(
+            '/admin/project/?flt0_%d=2' % approve_filter))
+        self.measure('project_edit_get', lambda n: superuser.get(
+            '/admin/project/edit/?id=%d' % project_id))
+        self.measure('project_edit_post', lambda n: superuser.post(
+            '/admin/project/edit/?id=%d' % project_id,
+            data=dict(edit_data, comment3='bench %d' % n)), expect=(200, 302))
+        self.measure('project_export_csv', lambda n: developer.get(
+            '/admin/project/export/csv/'))
+        self.measure('file_list', lambda n: developer.get('/admin/fileview/'))
+        self.measure('file_upload', lambda n: developer.post(
+            '/admin/fileview/upload/', data=dict(
+                upload=(io.BytesIO(b'x' * 65536), 'bench-%d.bin' % n)),
+            content_type='multipart/form-data'), expect=(200, 302))
+        email = self.user_email('developer')
+        self.measure('login', lambda n: self.app.test_client().post(
+            '/admin/login/', data=dict(email=email, password=PASSWORD)), expect=(302,))
+        return self.results
+
+
+def compare(current, previous):
+    print('%-24s %12s %12s %8s' % ('scenario', 'p95 before', 'p95 now', 'change'))
+    for name, result in sorted(current['scenarios'].items()):
+        old = previous['scenarios'].get(name)
+        if not old:
+            continue
+        change = (result['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100 if old['p95_ms'] else 0
+        print('%-24s %12.2f %12.2f %+7.1f%%' % (name, old['p95_ms'], result['p95_ms'], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--teams', type=int, default=20)
+    parser.add_argument('--projects', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the JSON run here instead of stdout')
+    parser.add_argument('--compare', help='JSON of a previous run to compare the p95 with')
+    args = parser.parse_args()
+
+    import app as rcs
+
+    workdir = tempfile.mkdtemp(prefix='rcs-bench-')
+    try:
+        app = rcs.create_app({
+            'SQLALCHEMY_ECHO': False,
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(workdir, 'bench.sqlite'),
+            'FILE_PATH': os.path.join(workdir, 'files'),
+            'FILE_STATE_PATH': os.path.join(workdir, 'file-state'),
+            'WTF_CSRF_ENABLED': False,
+            'REQUEST_STATS_ENABLED': True,
+            # No background worker polling the outbox during the run
+            'NOTIFY_ENABLED': False,
+        })
+        with app.app_context():
+            fixtures.generate(rcs, args.users, args.teams, args.projects, args.seed,
+                              PASSWORD, unique_hashes=False)
+        results = Bench(rcs, app, args.iterations).run()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    run = dict(
+        created_at=datetime.datetime.utcnow().isoformat() + 'Z',
+        python=platform.python_version(),
+        dataset=dict(users=args.users, teams=args.teams, projects=args.projects, seed=args.seed),
+        iterations=args.iterations,
+        scenarios=results,
+    )
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run, f, indent=2, sort_keys=True)
+    else:
+        json.dump(run, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(run, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
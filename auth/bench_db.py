@@ -0,0 +1,141 @@
+"""
+Throughput of concurrent SWProjectView.update_model calls per database profile.
+
+    python bench_db.py [--threads 8] [--updates 400] [profile ...]
+
+The sqlite profiles run against a throw-away database file. The postgresql
+profile runs only when --pg-url is given, and that database is wiped.
+Each profile runs in its own process, as the engine is set up at import.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+PROFILES = ('sqlite', 'sqlite-wal', 'postgresql')
+
+
+def seed(rcs, projects):
+    rcs.db.drop_all()
+    rcs.db.create_all()
+    rcs.create_search_index()
+
+    superuser = rcs.Role(name='superuser')
+    team = rcs.Team(name='Bench')
+    user = rcs.User(first_name='Bench', email='bench@example.com', active=True,
+                    password='x', roles=[superuser], teams=team)
+    rcs.db.session.add(user)
+    for i in range(projects):
+        rcs.db.session.add(rcs.Project(
+            teams='Bench', name='Bench', project_name='project %d' % i, version='1.0',
+            SVN='svn://bench/%d' % i, notes='notes', reviewer1='Bench', reviewer2='Bench',
+            review1=True, review2=True))
+    rcs.db.session.commit()
+    return user.id
+
+
+def run(profile, threads, updates):
+    import app as rcs
+    from flask_login import login_user
+
+    app = rcs.create_app({'SQLALCHEMY_ECHO': False})
+    with app.app_context():
+        user_id = seed(rcs, threads * 4)
+        project_ids = [p.id for p in rcs.Project.query.all()]
+        rcs.db.session.remove()
+    admin = app.extensions['admin'][0]
+    view = [v for v in admin._views if isinstance(v, rcs.SWProjectView)][0]
+
+    errors = []
+
+    def update(project_id, n):
+        data = {'project_name': 'project', 'version': '1.%d' % n, 'SVN': 'svn://bench',
+                'notes': 'notes', 'comment1': 'ok', 'review1': 'y', 'comment2': 'ok',
+                'review2': 'y', 'comment3': 'update %d' % n}
+        with app.test_request_context(method='POST', data=data):
+            try:
+                login_user(rcs.User.query.get(user_id))
+                model = view.get_one(str(project_id))
+                form = view.edit_form(obj=model)
+                view._validate_form_instance(ruleset=view._form_edit_rules, form=form)
+                view.update_model(form, model)
+            except Exception as ex:
+                rcs.db.session.rollback()
+                errors.append(repr(ex))
+            finally:
+                rcs.db.session.remove()
+
+    def worker(count):
+        for n in range(count):
+            update(random.choice(project_ids), n)
+
+    per_thread = max(updates // threads, 1)
+    pool = [threading.Thread(target=worker, args=(per_thread,)) for _ in range(threads)]
+    start = time.time()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.time() - start
+
+    total = per_thread * threads
+    return dict(profile=profile, threads=threads, updates=total, seconds=round(elapsed, 3),
+                updates_per_second=round(total / elapsed, 1), errors=len(errors),
+                first_error=errors[0] if errors else None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('profiles', nargs='*', default=['sqlite', 'sqlite-wal', 'postgresql'])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--updates', type=int, default=400)
+    parser.add_argument('--pg-url', help='PostgreSQL URL for the postgresql profile (WIPED)')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        result = run(args.run, args.threads, args.updates)
+        print('RESULT ' + json.dumps(result))
+        return
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    for profile in args.profiles:
+        if profile not in PROFILES:
+            parser.error('unknown profile %r' % profile)
+
+        env = dict(os.environ, RCS_DB_PROFILE=profile)
+        workdir = None
+        if profile == 'postgresql':
+            if not args.pg_url:
+                print('%-12s skipped (no --pg-url)' % profile)
+                continue
+            env['RCS_DATABASE_URL'] = args.pg_url
+        else:
+            workdir = tempfile.mkdtemp(prefix='rcs-bench-')
+            env['RCS_DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.sqlite')
+
+        try:
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), '--run', profile,
+                 '--threads', str(args.threads), '--updates', str(args.updates)],
+                cwd=here, env=env, universal_newlines=True)
+        finally:
+            if workdir:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+        for line in output.splitlines():
+            if line.startswith('RESULT '):
+                result = json.loads(line[len('RESULT '):])
+                print('%-12s %3d threads %5d updates %8.3fs %8.1f updates/s %4d errors' % (
+                    profile, result['threads'], result['updates'], result['seconds'],
+                    result['updates_per_second'], result['errors']))
+
+
+if __name__ == '__main__':
+    main()
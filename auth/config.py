@@ -1,11 +1,75 @@
+import os
+from sqlalchemy.pool import QueuePool
+
 # Create dummy secrey key so we can use sessions
 SECRET_KEY = '123456790'
 
 # Create in-memory database
 DATABASE_FILE = 'sample_db.sqlite'
-SQLALCHEMY_DATABASE_URI = 'sqlite:///' + DATABASE_FILE
+SQLALCHEMY_DATABASE_URI = os.environ.get('RCS_DATABASE_URL', 'sqlite:///' + DATABASE_FILE)
 SQLALCHEMY_ECHO = True
 
+# Database engine profile, selected with RCS_DB_PROFILE:
+#   sqlite      the defaults above
+#   sqlite-wal  SQLite in WAL mode, tuned for concurrent reviewers
+#   postgresql  PostgreSQL at RCS_DATABASE_URL (needs psycopg2)
+DB_PROFILE = os.environ.get('RCS_DB_PROFILE', 'sqlite')
+
+# PRAGMAs run on every new SQLite connection
+SQLITE_PRAGMAS = {}
+
+if DB_PROFILE == 'sqlite-wal':
+    # Readers no longer block the writer, and a writer waits for the lock
+    # instead of failing with "database is locked"
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+    }
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'poolclass': QueuePool,
+        'pool_size': 10,
+        'max_overflow': 10,
+        'pool_timeout': 10,
+        'connect_args': {'timeout': 5, 'check_same_thread': False},
+    }
+
+if DB_PROFILE == 'postgresql':
+    SQLALCHEMY_DATABASE_URI = os.environ.get('RCS_DATABASE_URL', 'postgresql://rcs@localhost/rcs')
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': 10,
+        'max_overflow': 20,
+        'pool_timeout': 30,
+        'pool_recycle': 1800,
+        'pool_pre_ping': True,
+    }
+
+# Directory served by the File view (None: the static directory of the app)
+FILE_PATH = os.environ.get('RCS_FILE_PATH')
+
+# State of the File view (uploads in progress, blob store, previews, document
+# index); None: file-state in the instance folder. Not served, and on the
+# same filesystem as FILE_PATH.
+FILE_STATE_PATH = os.environ.get('RCS_FILE_STATE_PATH')
+
+# Seconds an unfinished chunked upload is kept after its last chunk; None
+# keeps them until they are cancelled
+CHUNKED_UPLOAD_EXPIRY = 24 * 60 * 60
+
+# Let the front-end server send File view downloads: None, 'x-sendfile'
+# (Apache/lighttpd) or 'x-accel' (nginx, with an internal location at
+# ARTIFACT_ACCEL_PREFIX aliased to FILE_PATH)
+ARTIFACT_OFFLOAD = os.environ.get('RCS_ARTIFACT_OFFLOAD')
+ARTIFACT_ACCEL_PREFIX = '/protected-static/'
+
+# File view previews: longest side in pixels, and the size of the preview
+# cache on disk before the least recently used previews are evicted
+PREVIEW_SIZE = 240
+PREVIEW_CACHE_BYTES = 256 * 1024 * 1024
+
+# Processes extracting the text of uploaded documents for the File view search
+DOCUMENT_INDEX_WORKERS = 2
+
 # Flask-Security config
 SECURITY_URL_PREFIX = "/admin"
 SECURITY_PASSWORD_HASH = "pbkdf2_sha512"
@@ -24,3 +88,48 @@ SECURITY_POST_REGISTER_VIEW = "/admin/"
 SECURITY_REGISTERABLE = True
 SECURITY_SEND_REGISTER_EMAIL = False
 SQLALCHEMY_TRACK_MODIFICATIONS = True
+
+# Count SQL statements and time per request: Server-Timing response header
+# and the Management > Request Stats page
+REQUEST_STATS_ENABLED = True
+
+# Reviewer notifications, sent by a worker from the outbox table. Deployed,
+# the worker runs on its own: FLASK_APP=app:create_app flask send-notifications
+# NOTIFY_ENABLED makes the development server (python app.py) run it in-process.
+# Transports: 'file' writes .eml files to NOTIFY_OUTBOX_DIR, 'smtp' sends to
+# NOTIFY_SMTP_HOST:NOTIFY_SMTP_PORT (python -m smtpd -n -c DebuggingServer localhost:1025)
+NOTIFY_ENABLED = True
+NOTIFY_TRANSPORT = os.environ.get('RCS_NOTIFY_TRANSPORT', 'file')
+NOTIFY_OUTBOX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'outbox')
+NOTIFY_SMTP_HOST = os.environ.get('RCS_SMTP_HOST', 'localhost')
+NOTIFY_SMTP_PORT = int(os.environ.get('RCS_SMTP_PORT', 1025))
+NOTIFY_SENDER = 'release-control@localhost'
+NOTIFY_BATCH_SIZE = 50
+NOTIFY_INTERVAL = 5
+NOTIFY_THREADS = 4
+NOTIFY_MAX_ATTEMPTS = 5
+# Seconds before the first retry of a failed notification, doubled each time
+NOTIFY_RETRY_DELAY = 30
+
+# Environment, selected with RCS_ENV: dev (default), test or prod.
+# test and prod turn off SQL echo and the modification tracking signals.
+RCS_ENV = os.environ.get('RCS_ENV', 'dev')
+
+# Queries slower than this (in milliseconds) are logged as JSON to the
+# "rcs.slow_query" logger; None disables the sampling
+SLOW_QUERY_THRESHOLD_MS = None
+# Fraction of the slow queries that are logged
+SLOW_QUERY_SAMPLE_RATE = 1.0
+
+if RCS_ENV in ('test', 'prod'):
+    SQLALCHEMY_ECHO = False
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+if RCS_ENV == 'test':
+    TESTING = True
+    NOTIFY_ENABLED = False
+    WTF_CSRF_ENABLED = False
+
+if RCS_ENV == 'prod':
+    SLOW_QUERY_THRESHOLD_MS = float(os.environ.get('RCS_SLOW_QUERY_MS', 200))
+    SLOW_QUERY_SAMPLE_RATE = float(os.environ.get('RCS_SLOW_QUERY_SAMPLE_RATE', 1.0))
@@ -0,0 +1,33 @@
+"""
+Move the files already under the File view into the content-addressed blob
+store, so identical copies share one inode, and drop unreferenced blobs.
+
+    python dedupe.py
+"""
+import os
+
+import app as rcs
+
+
+def main():
+    app = rcs.create_app({'SQLALCHEMY_ECHO': False, 'NOTIFY_ENABLED': False})
+    with app.app_context():
+        admin = app.extensions['admin'][0]
+        view = [v for v in admin._views if isinstance(v, rcs.FileView)][0]
+        base_path = view.get_base_path()
+        store = view.blob_store()
+
+        absorbed = store.absorb_tree(base_path)
+        removed = store.collect()
+
+        blobs = stored = 0
+        for directory, dirs, files in os.walk(store.root):
+            for name in files:
+                blobs += 1
+                stored += os.path.getsize(os.path.join(directory, name))
+    print('%d files absorbed, %d unreferenced blobs removed, %d blobs (%d bytes) stored'
+          % (absorbed, removed, blobs, stored))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""
+Generate a load-test dataset for the Release Control System.
+
+    python fixtures.py [--users 2000] [--teams 50] [--projects 200000] [--seed 1]
+
+The database of the current config is WIPED and refilled with roles, teams,
+users (with their role and team links) and projects (with their
+project_users reviewer links). Rows are written with bulk inserts, and all
+users share one password hash unless --unique-hashes is given, so a large
+dataset takes seconds. The same --seed always gives the same data.
+"""
+import argparse
+import datetime
+import random
+import time
+
+ROLES = ('developer', 'reviewer1', 'reviewer2', 'superuser', 'administrator', 'visitor')
+
+# Share of the users in each role
+ROLE_WEIGHTS = (('developer', 70), ('reviewer1', 12), ('reviewer2', 10),
+                ('superuser', 5), ('administrator', 1), ('visitor', 2))
+
+FIRST_NAMES = [
+    'Harry', 'Amelia', 'Oliver', 'Jack', 'Isabella', 'Charlie', 'Sophie', 'Mia',
+    'Jacob', 'Thomas', 'Emily', 'Lily', 'Ava', 'Isla', 'Alfie', 'Olivia', 'Jessica',
+    'Riley', 'William', 'James', 'Geoffrey', 'Lisa', 'Benjamin', 'Stacey', 'Lucy'
+]
+LAST_NAMES = [
+    'Brown', 'Smith', 'Patel', 'Jones', 'Williams', 'Johnson', 'Taylor', 'Thomas',
+    'Roberts', 'Khan', 'Lewis', 'Jackson', 'Clarke', 'James', 'Phillips', 'Wilson',
+    'Ali', 'Mason', 'Mitchell', 'Rose', 'Davis', 'Davies', 'Rodriguez', 'Cox', 'Alexander'
+]
+
+BATCH_SIZE = 10000
+
+
+def batches(rows, size=BATCH_SIZE):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def bulk_insert(rcs, model, rows):
+    for batch in batches(rows):
+        rcs.db.session.bulk_insert_mappings(model, batch)
+
+
+def executemany(rcs, table, rows):
+    for batch in batches(rows):
+        rcs.db.session.execute(table.insert(), batch)
+
+
+def pick_role(rng):
+    n = rng.randint(1, sum(weight for role, weight in ROLE_WEIGHTS))
+    for role, weight in ROLE_WEIGHTS:
+        n -= weight
+        if n <= 0:
+            return role
+
+
+def generate(rcs, users, teams, projects, seed, password, unique_hashes):
+    from flask_security.utils import encrypt_password
+
+    rng = random.Random(seed)
+    db = rcs.db
+
+    db.drop_all()
+    db.create_all()
+
+    bulk_insert(rcs, rcs.Role, [dict(id=i + 1, name=name) for i, name in enumerate(ROLES)])
+    role_ids = dict((name, i + 1) for i, name in enumerate(ROLES))
+
+    bulk_insert(rcs, rcs.Team, [dict(id=i + 1, name='Team %03d' % (i + 1),
+                                     description='Load test team %d' % (i + 1))
+                                for i in range(teams)])
+
+    shared_hash = None if unique_hashes else encrypt_password(password)
+    user_rows, role_links, team_links = [], [], []
+    by_role = dict((name, []) for name in ROLES)
+    for i in range(users):
+        user_id = i + 1
+        first_name = '%s%d' % (FIRST_NAMES[i % len(FIRST_NAMES)], i // len(FIRST_NAMES))
+        last_name = LAST_NAMES[rng.randrange(len(LAST_NAMES))]
+        role = 'administrator' if i == 0 else pick_role(rng)
+        team_id = rng.randint(1, teams)
+        user_rows.append(dict(
+            id=user_id, first_name=first_name, last_name=last_name,
+            email='%s.%s@example.com' % (first_name.lower(), last_name.lower()),
+            password=shared_hash or encrypt_password(password), active=True))
+        role_links.append(dict(user_id=user_id, role_id=role_ids[role]))
+        team_links.append(dict(team_id=team_id, user_id=user_id))
+        by_role[role].append((user_id, first_name, team_id))
+
+    bulk_insert(rcs, rcs.User, user_rows)
+    executemany(rcs, rcs.roles_users, role_links)
+    executemany(rcs, rcs.teams_users, team_links)
+
+    developers = by_role['developer'] or by_role['administrator']
+    reviewers1 = by_role['reviewer1'] or developers
+    reviewers2 = by_role['reviewer2'] or developers
+    now = datetime.datetime(2017, 6, 1)
+    project_rows, reviewer_links = [], []
+    for i in range(projects):
+        project_id = i + 1
+        dev_id, dev_name, team_id = developers[rng.randrange(len(developers))]
+        r1_id, r1_name, _ = reviewers1[rng.randrange(len(reviewers1))]
+        r2_id, r2_name, _ = reviewers2[rng.randrange(len(reviewers2))]
+        review1 = rng.random() < 0.8 or None
+        review2 = (review1 and rng.random() < 0.7) or None
+        approve = (review2 and rng.random() < 0.8) or None
+        submitted_at = now - datetime.timedelta(seconds=rng.randint(0, 2 * 365 * 86400))
+        project_rows.append(dict(
+            id=project_id, teams='Team %03d' % team_id, team_id=team_id,
+            name=dev_name, owner_id=dev_id,
+            project_name='Project %d' % rng.randint(1, projects // 10 + 1),
+            version='%d.%d.%d' % (rng.randint(1, 5), rng.randint(0, 20), rng.randint(0, 99)),
+            SVN='svn://svn.example.com/release/%d' % project_id,
+            notes='Release notes for build %d' % project_id,
+            submitted_at=submitted_at,
+            reviewer1=r1_name, reviewer1_id=r1_id, review1=review1,
+            comment1='Reviewed' if review1 else None,
+            reviewer2=r2_name, reviewer2_id=r2_id, review2=review2,
+            comment2='Reviewed' if review2 else None,
+            approve=approve, comment3='Approved' if approve else None,
+            review_stage=('approved' if approve else 'pending_final' if review2
+                          else 'pending_r2' if review1 else 'pending_r1')))
+        reviewer_links.append(dict(user_id=r1_id, project_id=project_id))
+
+    bulk_insert(rcs, rcs.Project, project_rows)
+    executemany(rcs, rcs.project_users, reviewer_links)
+    db.session.commit()
+
+    # The bulk inserts bypass the mapper events, so index the text in one go
+    rcs.create_search_index(rebuild=True)
+    return dict(roles=len(ROLES), teams=teams, users=users, projects=projects)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--teams', type=int, default=50)
+    parser.add_argument('--projects', type=int, default=200000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--password', default='password',
+                        help='password of every generated user')
+    parser.add_argument('--unique-hashes', action='store_true',
+                        help='hash the password once per user (slow)')
+    args = parser.parse_args()
+
+    import app as rcs
+
+    app = rcs.create_app({'SQLALCHEMY_ECHO': False})
+    start = time.time()
+    with app.app_context():
+        counts = generate(rcs, args.users, args.teams, args.projects, args.seed,
+                          args.password, args.unique_hashes)
+    print('%(roles)d roles, %(teams)d teams, %(users)d users, %(projects)d projects' % counts
+          + ' in %.1fs' % (time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
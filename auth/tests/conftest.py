@@ -0,0 +1,50 @@
+import os
+import sys
+
+import pytest
+
+os.environ['RCS_ENV'] = 'test'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as rcs
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    def make_app(**config):
+        settings = {
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'test.sqlite'),
+            'FILE_PATH': str(tmp_path / 'files'),
+            'FILE_STATE_PATH': str(tmp_path / 'file-state'),
+        }
+        settings.update(config)
+        return rcs.create_app(settings)
+    return make_app
+
+
+@pytest.fixture
+def app(make_app):
+    app = make_app()
+    with app.app_context():
+        rcs.db.create_all()
+    return app
+
+
+# Creates a user with the given roles and returns a test client logged in as them
+@pytest.fixture
+def login(app):
+    def login(first_name, *role_names):
+        with app.app_context():
+            for name in role_names:
+                rcs.user_datastore.find_or_create_role(name)
+            rcs.db.session.commit()
+            rcs.user_datastore.create_user(
+                first_name=first_name, email=first_name.lower() + '@example.com',
+                password=rcs.encrypt_password('password'), roles=list(role_names))
+            rcs.db.session.commit()
+        client = app.test_client()
+        response = client.post('/admin/login/', data=dict(
+            email=first_name.lower() + '@example.com', password='password'))
+        assert response.status_code == 302
+        return client
+    return login
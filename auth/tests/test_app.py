@@ -0,0 +1,691 @@
+import datetime
+import hashlib
+import io
+import os
+import re
+import shutil
+import threading
+import time
+import zipfile
+
+import pytest
+from flask_admin.model.template import macro
+from flask_login import login_user
+from sqlalchemy import event
+
+import app as rcs
+
+
+# The app is built before any table exists, as on a fresh deployment
+def test_create_app_on_empty_database(make_app):
+    app = make_app()
+    assert app.extensions['admin'][0]
+    with app.app_context():
+        assert not rcs.db.engine.dialect.has_table(rcs.db.engine, 'team')
+    assert app.test_client().get('/').status_code == 200
+
+
+# The startup upgrade runs on the shipped sample database, and again on the
+# upgraded one without failing
+def test_startup_upgrade_on_sample_database(make_app, tmp_path):
+    database = tmp_path / 'sample.sqlite'
+    shutil.copy(os.path.join(os.path.dirname(rcs.__file__), 'sample_db.sqlite'), str(database))
+    app = make_app(SQLALCHEMY_DATABASE_URI='sqlite:///' + str(database))
+    for _ in range(2):
+        with app.app_context():
+            rcs.db.create_all()
+            rcs.add_review_stage_column()
+            rcs.migrate_reference_columns()
+            rcs.create_project_indexes()
+            rcs.create_search_index()
+            names = set(index['name'] for index in rcs.inspect(rcs.db.engine).get_indexes('project'))
+            assert names >= set(index.name for index in rcs.Project.__table__.indexes)
+            assert rcs.Project.query.count()
+
+
+def test_upgrade_db_command_upgrades_the_sample_database(make_app, tmp_path):
+    database = tmp_path / 'sample.sqlite'
+    shutil.copy(os.path.join(os.path.dirname(rcs.__file__), 'sample_db.sqlite'), str(database))
+    app = make_app(SQLALCHEMY_DATABASE_URI='sqlite:///' + str(database))
+    result = app.test_cli_runner().invoke(args=['upgrade-db'])
+    assert result.exit_code == 0, result.output
+    assert 'projects with unresolved references' in result.output
+    with app.app_context():
+        assert rcs.Project.query.count()
+        assert rcs.Project.query.filter(rcs.Project.review_stage != None).count()
+
+
+def test_reference_backfill_resolves_unique_names(app):
+    with app.app_context():
+        team = rcs.Team(name=u'Drives')
+        ann = rcs.User(first_name=u'Ann', email='ann@example.com')
+        bob = rcs.User(first_name=u'Bob', email='bob@example.com')
+        rcs.db.session.add_all([team, ann, bob,
+                                rcs.User(first_name=u'Cy', email='cy1@example.com'),
+                                rcs.User(first_name=u'Cy', email='cy2@example.com')])
+        rcs.db.session.add_all([
+            rcs.Project(project_name=u'gearbox', notes=u'n', name=u'Ann', teams=u'Drives',
+                        reviewer1=u'Bob', reviewer2=u'Ann'),
+            rcs.Project(project_name=u'clutch', notes=u'n', name=u'Cy', teams=u'Drives',
+                        reviewer1=u'Bob', reviewer2=u'Ann'),
+        ])
+        rcs.db.session.commit()
+
+        assert rcs.migrate_reference_columns(batch_size=1) == 1
+        rcs.db.session.expire_all()
+        gearbox = rcs.Project.query.filter_by(project_name=u'gearbox').one()
+        assert (gearbox.owner_id, gearbox.team_id, gearbox.reviewer1_id, gearbox.reviewer2_id) == \
+            (ann.id, team.id, bob.id, ann.id)
+        # The shared first name stays unresolved, the rest of the row is filled in
+        clutch = rcs.Project.query.filter_by(project_name=u'clutch').one()
+        assert (clutch.owner_id, clutch.team_id, clutch.reviewer1_id) == (None, team.id, bob.id)
+
+
+def test_search_index_follows_schema(make_app):
+    app = make_app()
+    with app.app_context():
+        # Writes before the index exists are not indexed, and don't fail;
+        # the upgrade builds the index from the existing rows
+        rcs.db.create_all()
+        rcs.drop_search_index(rcs.db.engine)
+        rcs.db.session.add(rcs.Project(project_name=u'orphan', notes=u'n'))
+        rcs.db.session.commit()
+        rcs.upgrade_database()
+        assert rcs.search_index_enabled(rcs.db.engine)
+        rows = rcs.db.engine.execute(rcs.db.text(
+            "SELECT rowid FROM project_fts WHERE project_fts MATCH 'orphan'")).fetchall()
+        assert [row[0] for row in rows] == [1]
+
+        rcs.db.drop_all()
+        rcs.db.create_all()
+        assert rcs.search_index_enabled(rcs.db.engine)
+        rcs.db.session.add(rcs.Project(project_name=u'gearbox', notes=u'firmware'))
+        rcs.db.session.commit()
+        rows = rcs.db.engine.execute(rcs.db.text(
+            "SELECT rowid FROM project_fts WHERE project_fts MATCH 'gearbox'")).fetchall()
+        assert [row[0] for row in rows] == [1]
+
+
+def test_notification_worker_retries_rows_one_by_one(make_app, tmp_path):
+    app = make_app(NOTIFY_OUTBOX_DIR=str(tmp_path / 'outbox'), NOTIFY_MAX_ATTEMPTS=2)
+    with app.app_context():
+        rcs.db.create_all()
+        user = rcs.User(first_name=u'Ann', email='ann@example.com')
+        project = rcs.Project(project_name=u'gearbox', version=u'1', notes=u'n')
+        rcs.db.session.add_all([user, project])
+        rcs.db.session.flush()
+        good = rcs.Notification(kind='review1', project=project, recipient_id=user.id)
+        poison = rcs.Notification(kind='review1', project=project, recipient_id=12345)
+        rcs.db.session.add_all([good, poison])
+        rcs.db.session.commit()
+        good_id, poison_id = good.id, poison.id
+
+    worker = rcs.NotificationWorker(app)
+    assert worker.send_pending() == 2
+    with app.app_context():
+        assert rcs.Notification.query.get(good_id).status == 'sent'
+        poison = rcs.Notification.query.get(poison_id)
+        assert (poison.status, poison.attempts) == ('pending', 1)
+        assert poison.next_attempt_at is not None
+    assert len(list((tmp_path / 'outbox').iterdir())) == 1
+
+    # Backing off: not due yet
+    assert worker.send_pending() == 0
+
+    # A claim left behind by a dead worker is an attempt; the last one fails it
+    with app.app_context():
+        poison = rcs.Notification.query.get(poison_id)
+        poison.status = 'sending'
+        poison.claimed_at = poison.claimed_at - worker.claim_timeout * 2
+        rcs.db.session.commit()
+    worker.send_pending()
+    with app.app_context():
+        poison = rcs.Notification.query.get(poison_id)
+        assert (poison.status, poison.attempts) == ('failed', 2)
+
+
+def test_chunked_upload_checks_checksums(app, login, tmp_path):
+    client = login(u'Dev', 'developer')
+    upload_id = client.post('/admin/fileview/chunked/start/', json=dict(
+        filename='data.bin', size=10)).get_json()['upload_id']
+    part_url = '/admin/fileview/chunked/part/%s?offset=0' % upload_id
+
+    assert client.put(part_url, data=b'0123456789').status_code == 400
+    response = client.put(part_url, data=b'0123456789',
+                          headers={'X-Chunk-SHA256': hashlib.sha256(b'other').hexdigest()})
+    assert response.status_code == 400
+    assert response.get_json()['received'] == 0
+    response = client.put(part_url, data=b'0123456789',
+                          headers={'X-Chunk-SHA256': hashlib.sha256(b'0123456789').hexdigest()})
+    assert response.get_json()['received'] == 10
+
+    # The parts are kept in the state path, not in the served folder
+    assert os.listdir(str(tmp_path / 'file-state' / 'uploads'))
+    finish_url = '/admin/fileview/chunked/finish/' + upload_id
+    assert client.post(finish_url, json=dict(sha256='0' * 64)).status_code == 400
+    assert client.post(finish_url, json=dict(
+        sha256=hashlib.sha256(b'0123456789').hexdigest())).status_code == 200
+    assert os.listdir(str(tmp_path / 'files')) == ['data.bin']
+    assert not os.listdir(str(tmp_path / 'file-state' / 'uploads'))
+
+
+def test_abandoned_chunked_uploads_expire(app, login, tmp_path):
+    client = login(u'Dev', 'developer')
+    uploads = tmp_path / 'file-state' / 'uploads'
+    old_id = client.post('/admin/fileview/chunked/start/', json=dict(
+        filename='old.bin', size=10)).get_json()['upload_id']
+    stale = time.time() - app.config['CHUNKED_UPLOAD_EXPIRY'] - 60
+    for name in os.listdir(str(uploads)):
+        os.utime(str(uploads / name), (stale, stale))
+
+    new_id = client.post('/admin/fileview/chunked/start/', json=dict(
+        filename='new.bin', size=10)).get_json()['upload_id']
+    assert sorted(os.listdir(str(uploads))) == [new_id + '.json', new_id + '.part']
+    assert client.get('/admin/fileview/chunked/part/' + old_id).status_code == 404
+
+
+def test_download_answers_range_and_etag(app, login, tmp_path):
+    client = login(u'Dev', 'developer')
+    (tmp_path / 'files').mkdir(exist_ok=True)
+    (tmp_path / 'files' / 'data.bin').write_bytes(b'0123456789')
+    digest = hashlib.sha256(b'0123456789').hexdigest()
+
+    response = client.get('/admin/fileview/download/data.bin', headers={'Range': 'bytes=2-5'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes 2-5/10'
+    assert response.get_data() == b'2345'
+    assert response.headers['ETag'] == '"%s"' % digest
+    with app.app_context():
+        assert rcs.ArtifactHash.query.get(u'data.bin').sha256 == digest
+
+    response = client.get('/admin/fileview/download/data.bin',
+                          headers={'If-None-Match': '"%s"' % digest})
+    assert response.status_code == 304
+
+
+def test_uploads_are_stored_as_blobs_outside_the_served_folder(app, login, tmp_path):
+    client = login(u'Dev', 'developer')
+    for name in ('a.txt', 'b.txt'):
+        response = client.post('/admin/fileview/upload/', data=dict(
+            upload=(io.BytesIO(b'hello'), name)), content_type='multipart/form-data')
+        assert response.status_code == 302
+    assert sorted(os.listdir(str(tmp_path / 'files'))) == ['a.txt', 'b.txt']
+
+    digest = hashlib.sha256(b'hello').hexdigest()
+    blob = tmp_path / 'file-state' / 'blobs' / digest[:2] / digest
+    assert os.stat(str(blob)).st_nlink == 3
+    with app.app_context():
+        assert rcs.ArtifactHash.query.get(u'a.txt').sha256 == digest
+
+
+def test_reviewer_directory_sees_other_process_edits(make_app):
+    app = make_app()
+    with app.app_context():
+        rcs.db.create_all()
+        role = rcs.Role(name='reviewer1')
+        rcs.db.session.add(rcs.User(first_name=u'Ann', email='ann@example.com', roles=[role]))
+        rcs.db.session.commit()
+        assert [label for pk, label in rcs.reviewer1_choices()] == [u'Ann <ann@example.com>']
+
+        # Another worker adds a reviewer: only the version stamp tells us
+        rcs.db.engine.execute(rcs.db.text(
+            "INSERT INTO user (id, first_name, email) VALUES (99, 'Bob', 'bob@example.com')"))
+        rcs.db.engine.execute(rcs.db.text(
+            "INSERT INTO roles_users (user_id, role_id) VALUES (99, %d)" % role.id))
+        assert [label for pk, label in rcs.reviewer1_choices()] == [u'Ann <ann@example.com>']
+        rcs.db.engine.execute(rcs.db.text(
+            "UPDATE cache_version SET version = version + 1 WHERE name = 'reviewers'"))
+        rcs.db.session.commit()
+        assert [label for pk, label in rcs.reviewer1_choices()] == [u'Ann <ann@example.com>', u'Bob <bob@example.com>']
+
+
+# Users sharing a first name are told apart by their full name and email; the
+# project keeps the id and, for display, the first name
+def test_reviewer_options_show_full_name_and_email(app):
+    with app.app_context():
+        role = rcs.Role(name='reviewer1')
+        rcs.db.session.add_all([
+            rcs.User(first_name=u'Cy', last_name=u'Adams', email='cy.adams@example.com', roles=[role]),
+            rcs.User(first_name=u'Cy', last_name=u'Baker', email='cy.baker@example.com', roles=[role]),
+        ])
+        rcs.db.session.commit()
+        baker_id = rcs.User.query.filter_by(last_name=u'Baker').one().id
+
+    with app.test_request_context():
+        form = project_view(app).create_form()
+        assert [label for pk, label in form.reviewer1.choices] == \
+            [u'Cy Adams <cy.adams@example.com>', u'Cy Baker <cy.baker@example.com>']
+        form.reviewer1.data = baker_id
+        project = rcs.Project()
+        form.reviewer1.populate_obj(project, 'reviewer1')
+        assert (project.reviewer1_id, project.reviewer1) == (baker_id, u'Cy')
+
+
+def file_view(app):
+    return [v for v in app.extensions['admin'][0]._views if isinstance(v, rcs.FileView)][0]
+
+
+def test_directory_delete_releases_only_its_blobs(app, tmp_path):
+    view = file_view(app)
+    files = tmp_path / 'files'
+    for folder, content in (('a', b'only in a'), ('b', b'shared')):
+        (files / folder).mkdir()
+        (files / folder / 'x.bin').write_bytes(content)
+    (files / 'a' / 'y.bin').write_bytes(b'shared')
+
+    with app.test_request_context():
+        for folder, name in (('a', 'x.bin'), ('a', 'y.bin'), ('b', 'x.bin')):
+            path = str(files / folder / name)
+            view.artifact_index().remember(folder + '/' + name, path, view.blob_store().absorb(path))
+        store = view.blob_store()
+        only_a = hashlib.sha256(b'only in a').hexdigest()
+        shared = hashlib.sha256(b'shared').hexdigest()
+        assert store.references(shared) == 2
+
+        view.before_directory_delete(str(files / 'a'), 'a')
+        shutil.rmtree(str(files / 'a'))
+        view.on_directory_delete(str(files / 'a'), 'a')
+
+        assert not os.path.exists(store.blob_path(only_a))
+        assert store.references(shared) == 1
+        assert rcs.ArtifactHash.query.get(u'a/x.bin') is None
+        assert rcs.ArtifactHash.query.get(u'b/x.bin') is not None
+
+
+def test_project_artifacts_need_project_access(app, login, tmp_path):
+    owner = login(u'Owner', 'developer')
+    other = login(u'Other', 'developer')
+    with app.app_context():
+        owner_id = rcs.User.query.filter_by(email=u'owner@example.com').one().id
+        project = rcs.Project(project_name=u'gearbox', notes=u'n', owner_id=owner_id)
+        rcs.db.session.add(project)
+        rcs.db.session.commit()
+        project_id = project.id
+    folder = tmp_path / 'files' / 'projects' / str(project_id)
+
+    # Opening the upload page doesn't create the folder
+    assert other.get('/admin/fileview/chunked/project/%d' % project_id).status_code == 403
+    assert owner.get('/admin/fileview/chunked/project/%d' % project_id).status_code == 200
+    assert not folder.exists()
+
+    start = '/admin/fileview/chunked/start/projects/%d' % project_id
+    assert other.post(start, json=dict(filename='a.txt', size=5)).status_code == 403
+    upload_id = owner.post(start, json=dict(filename='a.txt', size=5)).get_json()['upload_id']
+    owner.put('/admin/fileview/chunked/part/%s?offset=0' % upload_id, data=b'hello',
+              headers={'X-Chunk-SHA256': hashlib.sha256(b'hello').hexdigest()})
+    assert owner.post('/admin/fileview/chunked/finish/' + upload_id).status_code == 200
+    assert os.listdir(str(folder)) == ['a.txt']
+
+    other.post('/admin/fileview/upload/projects/%d' % project_id, data=dict(
+        upload=(io.BytesIO(b'mine'), 'b.txt')), content_type='multipart/form-data')
+    assert os.listdir(str(folder)) == ['a.txt']
+    with app.app_context():
+        assert [a.path for a in rcs.ProjectArtifact.query] == [u'projects/%d/a.txt' % project_id]
+
+
+def project_view(app):
+    return [v for v in app.extensions['admin'][0]._views if isinstance(v, rcs.SWProjectView)][0]
+
+
+def add_projects(app, count, **values):
+    with app.app_context():
+        start = datetime.datetime(2020, 1, 1)
+        projects = [rcs.Project(project_name=u'p%d' % i, notes=u'n',
+                                submitted_at=start + datetime.timedelta(days=i), **values)
+                    for i in range(count)]
+        rcs.db.session.add_all(projects)
+        rcs.db.session.commit()
+        return [project.id for project in projects]
+
+
+def test_bulk_approve_updates_allowed_projects_and_reports_skipped(app, login):
+    ready = add_projects(app, 2, review1=True, review2=True)
+    pending = add_projects(app, 1)
+    client = login(u'Boss', 'superuser')
+    response = client.post('/admin/project/action/', data=dict(
+        action='approve', rowid=[str(pk) for pk in ready + pending + [999]]))
+    assert response.status_code == 302
+    with app.app_context():
+        assert [rcs.Project.query.get(pk).approve for pk in ready + pending] == [True, True, None]
+    with client.session_transaction() as session:
+        flashes = session['_flashes']
+    assert flashes[0] == ('message', '2 project(s) updated.')
+    assert flashes[1][0] == 'error'
+    assert 'You are not the current approver!' in flashes[1][1]
+    assert '1 project(s) not found.' in flashes[1][1]
+
+
+# The search box matches the notes too; the hits come by rank, or in the
+# order of the selected sort column
+def test_project_search_ranks_hits_unless_sorted(app, login):
+    ids = add_projects(app, 3)
+    with app.app_context():
+        for pk, notes in zip(ids, (u'gearbox gearbox gearbox', u'gearbox and clutch', u'clutch')):
+            rcs.Project.query.get(pk).notes = notes
+        rcs.db.session.commit()
+    client = login(u'Dev', 'developer')
+
+    def shown(url):
+        html = client.get(url).get_data(as_text=True)
+        return re.findall(r'<td class="col-project_name">\s*(p\d)', html)
+
+    assert shown('/admin/project/?search=gear') == ['p0', 'p1']
+    sort = [name for name, label in project_view(app)._list_columns].index('project_name')
+    assert shown('/admin/project/?search=gear&sort=%d&desc=1' % sort) == ['p1', 'p0']
+
+
+# Pages are read from the cursor in the links; the projects without a
+# submitted_at come last
+def test_project_list_keyset_pages(app, login):
+    add_projects(app, 5)
+    with app.app_context():
+        undated = [rcs.Project(project_name=u'u%d' % i, notes=u'n') for i in range(2)]
+        rcs.db.session.add_all(undated)
+        rcs.db.session.commit()
+        rcs.db.engine.execute(rcs.db.text(
+            "UPDATE project SET submitted_at = NULL WHERE project_name LIKE 'u%'"))
+    project_view(app).page_size = 3
+    client = login(u'Dev', 'developer')
+
+    def page(url):
+        html = client.get(url.replace('&amp;', '&')).get_data(as_text=True)
+        links = dict((name, re.search(r'href="(/admin/project/\?[^"]*%s=[^"]*)"' % name, html))
+                     for name in ('after', 'before'))
+        return re.findall(r'<td class="col-project_name">\s*([pu]\d)', html), links
+
+    shown, links = page('/admin/project/')
+    assert shown == ['p4', 'p3', 'p2']
+    shown, links = page(links['after'].group(1))
+    assert shown == ['p1', 'p0', 'u1']
+    shown, links = page(links['after'].group(1))
+    assert shown == ['u0']
+    shown, links = page(links['before'].group(1))
+    assert shown == ['p1', 'p0', 'u1']
+
+
+# The CSV export streams the list query, newest first, and still refuses the
+# macro formatters it can't render
+def test_project_export_streams_rows(app, login):
+    add_projects(app, 3)
+    client = login(u'Dev', 'developer')
+    response = client.get('/admin/project/export/csv/')
+    assert response.status_code == 200
+    lines = response.get_data(as_text=True).splitlines()
+    assert [line.split(',')[2] for line in lines[1:]] == ['p2', 'p1', 'p0']
+
+    project_view(app).column_formatters_export = dict(project_name=macro('render_name'))
+    with pytest.raises(NotImplementedError):
+        client.get('/admin/project/export/csv/')
+
+
+def add_user(app, first_name, *role_names):
+    with app.app_context():
+        roles = [rcs.user_datastore.find_or_create_role(name) for name in role_names]
+        user = rcs.User(first_name=first_name, email=first_name.lower() + '@example.com',
+                        active=True, roles=roles)
+        rcs.db.session.add(user)
+        rcs.db.session.commit()
+        return user.id
+
+
+# Collects the SQL statements run on the app's engine
+class QueryCounter(object):
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+
+# The roles are read once per request, with the user, and kept on g
+def test_role_checks_run_no_sql(app):
+    user_id = add_user(app, u'Rev', 'reviewer1', 'visitor')
+    with app.test_request_context():
+        login_user(rcs.User.query.get(user_id))
+        with QueryCounter(rcs.db.engine) as counter:
+            assert rcs.current_roles() == frozenset(['reviewer1', 'visitor'])
+            assert rcs.user_has_role('developer', 'reviewer1')
+            assert not rcs.user_has_role('administrator')
+            assert project_view(app).is_accessible()
+            assert file_view(app).is_accessible()
+        assert counter.statements == []
+
+
+# Two requests running at the same time on the shared view instances each see
+# the permissions of their own user
+def test_permissions_are_per_request(app):
+    users = dict(developer=add_user(app, u'Dev', 'developer'),
+                 administrator=add_user(app, u'Admin', 'administrator'))
+    barrier = threading.Barrier(len(users))
+    seen = {}
+
+    def handle(role):
+        with app.test_request_context():
+            login_user(rcs.User.query.get(users[role]))
+            projects, files = project_view(app), file_view(app)
+            barrier.wait()
+            seen[role] = (projects.can_create, projects.can_delete, files.can_upload, files.can_mkdir)
+            barrier.wait()
+            rcs.db.session.remove()
+
+    threads = [threading.Thread(target=handle, args=(role,)) for role in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert seen == dict(developer=(True, False, True, False),
+                        administrator=(False, True, False, True))
+    assert 'can_create' not in vars(project_view(app))
+    with app.test_request_context():
+        assert not project_view(app).can_create
+
+
+# One rule set per role, built once and picked on each request
+def test_edit_rule_sets_are_built_once_per_role(app):
+    roles = ('developer', 'reviewer1', 'superuser')
+    users = dict((role, add_user(app, role.capitalize(), role)) for role in roles)
+    view = project_view(app)
+    picked = {}
+    for role in roles + roles:
+        with app.test_request_context():
+            login_user(rcs.User.query.get(users[role]))
+            rule_set = view._form_edit_rules
+            assert picked.setdefault(role, rule_set) is rule_set
+            assert view._form_create_rules is view._form_create_rules
+    assert len(set(id(rule_set) for rule_set in picked.values())) == len(roles)
+
+    def readonly(role):
+        return [rule.field_name for rule in picked[role].rules
+                if getattr(rule, 'extra_field_args', {}).get('readonly')]
+    assert readonly('developer') == ['project_name', 'version', 'SVN',
+                                     'comment1', 'comment2', 'comment3']
+    assert readonly('reviewer1') == ['notes', 'review1', 'comment2', 'comment3']
+    assert readonly('superuser') == []
+
+
+# A page of the user list costs the same number of queries however many
+# users (with their roles and team) it shows
+def test_user_list_queries_dont_grow_with_rows(app, login):
+    client = login(u'Admin', 'administrator')
+
+    def list_queries(count):
+        with app.app_context():
+            team = rcs.Team(name=u'team%d' % count)
+            roles = [rcs.user_datastore.find_or_create_role(name) for name in ('developer', 'visitor')]
+            for i in range(count):
+                rcs.user_datastore.create_user(
+                    first_name=u'U%d' % i, email='u%d.%d@example.com' % (count, i),
+                    roles=roles, teams=team)
+            rcs.db.session.commit()
+            engine = rcs.db.engine
+        with QueryCounter(engine) as counter:
+            response = client.get('/admin/users/')
+        assert response.status_code == 200
+        assert response.get_data(as_text=True).count('team%d' % count) == count
+        return len(counter.statements)
+
+    assert list_queries(3) == list_queries(10)
+
+
+# The queue shows the projects waiting on the reviewer; a review moves the
+# project on to the next queue
+def test_review_queues_follow_review_stage(app, login):
+    first = login(u'Rev', 'reviewer1')
+    second = login(u'Sec', 'reviewer2')
+    with app.app_context():
+        rev_id = rcs.User.query.filter_by(first_name=u'Rev').one().id
+        sec_id = rcs.User.query.filter_by(first_name=u'Sec').one().id
+        projects = dict((name, rcs.Project(project_name=name, notes=u'n', **values)) for name, values in (
+            (u'mine', dict(reviewer1_id=rev_id, reviewer2_id=sec_id)),
+            (u'also_mine', dict(reviewer1_id=rev_id)),
+            (u'not_mine', dict(reviewer1_id=sec_id)),
+            (u'done', dict(reviewer1_id=rev_id, review1=True, review2=True, approve=True,
+                           review_stage=u'approved')),
+        ))
+        rcs.db.session.add_all(projects.values())
+        rcs.db.session.commit()
+        mine_id = projects[u'mine'].id
+
+    def queue(client, endpoint):
+        html = client.get('/admin/%s/' % endpoint).get_data(as_text=True)
+        return sorted(re.findall(r'<td class="col-project_name">\s*(\w+)', html))
+
+    assert queue(first, 'queue_reviewer1') == [u'also_mine', u'mine']
+    assert queue(second, 'queue_reviewer2') == []
+    first.post('/admin/queue_reviewer1/action/', data=dict(action='mark_reviewed', rowid=[str(mine_id)]))
+    with app.app_context():
+        assert rcs.Project.query.get(mine_id).review_stage == u'pending_r2'
+    assert queue(first, 'queue_reviewer1') == [u'also_mine']
+    assert queue(second, 'queue_reviewer2') == [u'mine']
+    assert first.get('/admin/queue_reviewer2/').status_code == 403
+
+
+def test_review_stage_of():
+    stages = [rcs.review_stage_of(rcs.Project(review1=review1, review2=review2, approve=approve))
+              for review1, review2, approve in ((None, None, None), (True, None, None),
+                                                (True, True, None), (True, True, True))]
+    assert stages == [u'pending_r1', u'pending_r2', u'pending_final', u'approved']
+
+
+def make_docx(paragraphs):
+    body = ''.join('<w:p><w:r><w:t>%s</w:t></w:r></w:p>' % text for text in paragraphs)
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w') as document:
+        document.writestr('word/document.xml',
+                          '<w:document xmlns:w="http://schemas.openxmlformats.org/'
+                          'wordprocessingml/2006/main"><w:body>%s</w:body></w:document>' % body)
+    return output.getvalue()
+
+
+# An uploaded document is indexed by the worker processes and found by the
+# words of its text, with the match marked in the snippet
+def test_uploaded_documents_are_searchable(app, login):
+    client = login(u'Dev', 'developer')
+    view = file_view(app)
+    try:
+        client.post('/admin/fileview/upload/', data=dict(
+            upload=(io.BytesIO(make_docx([u'Torque limits', u'The gearbox firmware was verified.'])),
+                    'sop.docx')), content_type='multipart/form-data')
+        deadline = time.time() + 30
+        while not view.document_index().search(u'gearbox') and time.time() < deadline:
+            time.sleep(0.1)
+    finally:
+        view.document_pool().shutdown()
+
+    html = client.get('/admin/fileview/search/?q=firm').get_data(as_text=True)
+    assert 'sop.docx' in html
+    assert '<mark>firmware</mark>' in html
+    html = client.get('/admin/fileview/search/?q=clutch').get_data(as_text=True)
+    assert 'sop.docx' not in html
+
+    view.document_index().remove(u'sop.docx')
+    assert view.document_index().search(u'gearbox') == []
+
+
+# The listing is scanned once and then kept current by the FileView's own
+# changes; a change made behind its back is seen through the directory mtime
+def test_directory_listing_cache(tmp_path):
+    root = tmp_path / 'files'
+    (root / 'sub').mkdir(parents=True)
+    for name in ('b.txt', 'a.txt', '.hidden'):
+        (root / name).write_bytes(b'x' * len(name))
+    cache = rcs.DirectoryListingCache(str(root), lambda path: not path.startswith('.'),
+                                      max_directories=1)
+    scans = []
+    scan = cache._scan
+    cache._scan = lambda directory: scans.append(directory) or scan(directory)
+
+    def names(**kwargs):
+        return [item[0] for item in cache.listing(str(root), **kwargs)]
+
+    assert names() == ['sub', 'a.txt', 'b.txt']
+    assert names(column=0, desc=True) == ['sub', 'b.txt', 'a.txt']
+    assert len(scans) == 1
+
+    (root / 'c.txt').write_bytes(b'c')
+    cache.add(str(root), 'c.txt')
+    os.remove(str(root / 'a.txt'))
+    cache.remove(str(root), 'a.txt')
+    assert names() == ['sub', 'b.txt', 'c.txt']
+    assert len(scans) == 1
+
+    (root / 'd.txt').write_bytes(b'd')
+    os.utime(str(root), ns=(0, 1))
+    assert names() == ['sub', 'b.txt', 'c.txt', 'd.txt']
+    assert len(scans) == 2
+
+    # Only max_directories listings are kept
+    cache.listing(str(root / 'sub'))
+    names()
+    assert len(scans) == 4
+
+
+# Previews are rendered once per artifact digest and size; past max_bytes the
+# least recently served ones are evicted
+def test_preview_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    rendered = []
+
+    def render_preview(source, target, size):
+        rendered.append(source)
+        with open(target, 'wb') as f:
+            f.write(b'x' * 100)
+        return True
+
+    monkeypatch.setattr(rcs, 'preview_extension', lambda name: '.jpg')
+    monkeypatch.setattr(rcs, 'render_preview', render_preview)
+    cache = rcs.PreviewCache(str(tmp_path / 'previews'), max_bytes=250)
+
+    first = cache.get('a.jpg', 'a' * 64, 240)
+    assert cache.get('a.jpg', 'a' * 64, 240) == first
+    assert rendered == ['a.jpg']
+    os.utime(first, (1, 1))
+    second = cache.get('b.jpg', 'b' * 64, 240)
+    os.utime(second, (2, 2))
+    cache.get('a.jpg', 'a' * 64, 240)
+    cache.get('c.jpg', 'c' * 64, 240)
+    assert rendered == ['a.jpg', 'b.jpg', 'c.jpg']
+    assert os.path.exists(first) and not os.path.exists(second)
+
+
+def test_image_preview_is_served(app, login, tmp_path):
+    image = pytest.importorskip('PIL.Image')
+    client = login(u'Dev', 'developer')
+    (tmp_path / 'files').mkdir(exist_ok=True)
+    image.new('RGB', (1200, 800), 'red').save(str(tmp_path / 'files' / 'shot.png'))
+
+    response = client.get('/admin/fileview/preview/shot.png')
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'
+    with image.open(io.BytesIO(response.get_data())) as preview:
+        assert max(preview.size) == app.config['PREVIEW_SIZE']
+    assert client.get('/admin/fileview/preview/shot.png', headers={
+        'If-None-Match': response.headers['ETag']}).status_code == 304
+